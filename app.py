@@ -1,21 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, Response, \
+    stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 import os
-from datetime import datetime
-from werkzeug.utils import secure_filename
+import math
+import hashlib
+from datetime import timezone
 from models import db
 import database  # модуль с функциями доступа к данным
+import map_points
+import images
+import metrics
+import nplusone
+import storage
+import serialization
+import passwords
 
 app = Flask(__name__)
+# orjson, если установлен; иначе стандартный json
+app.json = serialization.JSONProvider(app)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# X-Query-Count и Server-Timing в каждом ответе - для отладки
+app.config['METRICS_DEBUG_HEADERS'] = os.environ.get('METRICS_DEBUG_HEADERS') == '1'
+# WAL, PRAGMA и раздельные пулы чтения/записи для SQLite: SQLITE_PROFILE=production|default
+storage.configure(app)
+# Хэширование паролей в пуле процессов: PASSWORD_HASH_METHOD, PASSWORD_POOL_SIZE, PASSWORD_QUEUE_LIMIT
+passwords.init_app(app)
 db.init_app(app)
+metrics.init_app(app)
+# Поиск N+1 запросов при разработке: NPLUSONE=warn|raise
+nplusone.init_app(app)
 
 with app.app_context():
+    storage.init_engines(app, db.engine)
     database.init_db()  # создаёт таблицы, если их нет
 
 # Flask-Login
@@ -36,15 +56,26 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    user_data = database.get_user_by_id(user_id)   # <-- исправлено: database., а не .get_user...
+    # Из кэша процесса; таблица user обычно не читается (см. database.PrincipalCache)
+    user_data = database.get_principal(user_id)
     if user_data:
         return User(user_data)
     return None
 
 
-def allowed_file(filename):
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def clear_failed_image(key):
+    """Вызывается пулом images, если варианты изображения не удалось создать"""
+    with app.app_context():
+        database.clear_image_path(key)
+
+
+images.processor.on_failure = clear_failed_image
+
+
+@app.template_global()
+def idea_image(image_path):
+    """URL'ы изображения идеи для <picture> в шаблонах"""
+    return images.image_urls(image_path, url_for)
 
 
 # Маршруты
@@ -84,22 +115,9 @@ def map_page():
         if cities_list:
             city = cities_list[0]
 
-    ideas = []
-    if city_id:
-        if show_implemented:
-            ideas = database.get_all_ideas(status='implemented', city_id=city_id)
-        else:
-            ideas = database.get_all_ideas(status='approved', city_id=city_id)
-    else:
-        if show_implemented:
-            ideas = database.get_all_ideas(status='implemented')
-        else:
-            ideas = database.get_all_ideas(status='approved')
-
     cities = database.get_all_cities()
 
     return render_template('map.html',
-                           ideas=ideas,
                            city=city,
                            cities=cities,
                            add_idea=add_idea,
@@ -116,22 +134,35 @@ def ideas_list():
     if status not in ['approved', 'implemented']:
         status = 'approved'
 
-    ideas = database.get_all_ideas(
+    sort = request.args.get('sort', 'new')
+    if sort not in database.IDEA_SORT_KEYS:
+        sort = 'new'
+    q = request.args.get('q', '').strip()
+
+    page = database.get_ideas_page(
         status=status,
         category=category if category != 'all' else None,
-        city_id=city_id if city_id else None
+        city_id=city_id if city_id else None,
+        sort=sort,
+        q=q,
+        after=request.args.get('after'),
+        before=request.args.get('before')
     )
 
     categories = ['спорт', 'культура', 'детский досуг', 'экология', 'транспорт', 'благоустройство']
     cities = database.get_all_cities()
 
     return render_template('ideas.html',
-                           ideas=ideas,
+                           ideas=page['ideas'],
+                           next_cursor=page['next_cursor'],
+                           prev_cursor=page['prev_cursor'],
                            categories=categories,
                            selected_category=category,
                            cities=cities,
                            selected_city_id=city_id,
-                           selected_status=status)
+                           selected_status=status,
+                           selected_sort=sort,
+                           search_query=q)
 
 
 @app.route('/implemented')
@@ -140,17 +171,25 @@ def implemented_ideas():
     category = request.args.get('category', 'all')
     city_id = request.args.get('city_id', type=int)
 
-    ideas = database.get_all_ideas(
+    filters = dict(
         status='implemented',
         category=category if category != 'all' else None,
         city_id=city_id if city_id else None
     )
+    # Шаблон показывает число комментариев - оно читается тем же запросом
+    page = database.get_ideas_page(after=request.args.get('after'),
+                                   before=request.args.get('before'),
+                                   fields=database.IDEA_LIST_FIELDS + ('comments_count',),
+                                   **filters)
 
     categories = ['спорт', 'культура', 'детский досуг', 'экология', 'транспорт', 'благоустройство']
     cities = database.get_all_cities()
 
     return render_template('implemented.html',
-                           ideas=ideas,
+                           ideas=page['ideas'],
+                           next_cursor=page['next_cursor'],
+                           prev_cursor=page['prev_cursor'],
+                           total_count=database.count_ideas(**filters),
                            categories=categories,
                            selected_category=category,
                            cities=cities,
@@ -182,6 +221,14 @@ def add_idea():
         except ValueError:
             errors.append('Координаты должны быть числами')
 
+        image_data = None
+        file = request.files.get('image')
+        if file and file.filename:
+            try:
+                image_data = images.read_upload(file)
+            except images.ImageError as e:
+                errors.append(str(e))
+
         if errors:
             for error in errors:
                 flash(error, 'danger')
@@ -195,25 +242,16 @@ def add_idea():
                                    default_longitude=longitude,
                                    default_city_id=city_id)
 
+        # Варианты изображения создаются в фоне, в базу сразу пишется ключ
         image_path = None
-        if 'image' in request.files:
-            file = request.files['image']
-            if file and file.filename:
-                if allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                    filename = f"{timestamp}_{filename}"
-
-                    upload_folder = app.config['UPLOAD_FOLDER']
-                    if not os.path.exists(upload_folder):
-                        os.makedirs(upload_folder)
-
-                    file_path = os.path.join(upload_folder, filename)
-                    file.save(file_path)
-                    image_path = filename
+        if image_data:
+            image_path = images.processor.save(image_data, app.config['UPLOAD_FOLDER'])
 
         idea_id = database.create_idea(title, description, category, latitude, longitude,
                                        current_user.id, city_id, image_path)
+        # Обработка могла упасть до того, как идея попала в базу
+        if image_path and images.processor.failed(image_path):
+            database.clear_image_path(image_path)
 
         flash('Идея успешно добавлена и отправлена на модерацию!', 'success')
         return redirect(url_for('idea_detail', idea_id=idea_id))
@@ -285,6 +323,12 @@ def add_comment(idea_id):
 
 
 # Административные маршруты
+ADMIN_TABS = [('pending', 'На модерации'), ('approved', 'Одобренные'), ('implemented', 'Реализованные')]
+ADMIN_IDEA_FIELDS = ('id', 'title', 'excerpt', 'category', 'username', 'city_name', 'status',
+                     'votes_count', 'created_at')
+ADMIN_PAGE_SIZE = 50
+
+
 @app.route('/admin')
 @login_required
 def admin_panel():
@@ -292,19 +336,42 @@ def admin_panel():
         flash('Доступ запрещен!', 'danger')
         return redirect(url_for('index'))
 
-    pending_ideas = database.get_all_ideas(status='pending')
-    approved_ideas = database.get_all_ideas(status='approved')
-    implemented_ideas = database.get_all_ideas(status='implemented')
-    stats = database.get_stats()
+    # Страница - только оболочка со счётчиками; списки идей вкладок
+    # подгружаются постранично из admin_ideas
+    counts = database.get_admin_counts()
+    return render_template('admin.html', tabs=ADMIN_TABS, **counts)
 
-    return render_template('admin.html',
-                           pending_ideas=pending_ideas,
-                           approved_ideas=approved_ideas,
-                           implemented_ideas=implemented_ideas,
-                           total_ideas=stats['total_ideas'],
-                           total_users=stats['total_users'],
-                           total_votes=stats['total_votes'],
-                           total_cities=stats['total_cities'])
+
+@app.route('/admin/ideas')
+@login_required
+def admin_ideas():
+    """Страница идей вкладки админки: короткие строки без комментариев"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    status = request.args.get('status', 'pending')
+    if status not in database.IDEA_STATUSES:
+        return jsonify({'success': False, 'message': 'Неизвестный статус'}), 400
+
+    page = database.get_ideas_page(status=status,
+                                   after=request.args.get('after'),
+                                   before=request.args.get('before'),
+                                   limit=request.args.get('limit', ADMIN_PAGE_SIZE, type=int),
+                                   fields=ADMIN_IDEA_FIELDS)
+    return jsonify({
+        'success': True,
+        'ideas': [{f: idea[f] for f in ADMIN_IDEA_FIELDS} for idea in page['ideas']],
+        'next_cursor': page['next_cursor'],
+        'prev_cursor': page['prev_cursor']
+    })
+
+
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if not current_user.is_admin:
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/admin/approve_idea/<int:idea_id>')
@@ -343,6 +410,38 @@ def implement_idea(idea_id):
     return redirect(url_for('admin_panel'))
 
 
+# Не больше стольких идей за один запрос модерации
+MAX_MODERATION_BATCH = 1000
+
+
+@app.route('/admin/ideas/status', methods=['POST'])
+@login_required
+def admin_ideas_status():
+    """Модерация пачкой: {"ids": [...], "status": "approved"} -> результат по каждой идее"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    data = request.get_json(silent=True) or {}
+    status = data.get('status')
+    ids = data.get('ids')
+    if status not in database.IDEA_STATUSES:
+        return jsonify({'success': False, 'message': 'Неизвестный статус'}), 400
+    if not isinstance(ids, list) or not ids or \
+            not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return jsonify({'success': False, 'message': 'ids должен быть непустым списком id идей'}), 400
+    if len(ids) > MAX_MODERATION_BATCH:
+        return jsonify({'success': False,
+                        'message': f'Не больше {MAX_MODERATION_BATCH} идей за раз'}), 400
+
+    results = database.update_ideas_status(ids, status)
+    return jsonify({
+        'success': True,
+        'status': status,
+        'updated': sum(1 for r in results.values() if r == 'updated'),
+        'results': [{'id': idea_id, 'result': result} for idea_id, result in results.items()]
+    })
+
+
 @app.route('/delete_idea/<int:idea_id>')
 @login_required
 def delete_idea(idea_id):
@@ -460,51 +559,225 @@ def admin_delete_city(city_id):
     return redirect(url_for('admin_cities'))
 
 
+API_IDEA_FIELDS = ('id', 'title', 'description', 'category', 'latitude', 'longitude',
+                   'votes_count', 'username', 'created_at', 'status', 'image_path')
+API_PAGE_SIZE = 500
+NDJSON_MIME_TYPE = 'application/x-ndjson'
+MAP_POINTS_LIMIT = 300  # больше идей в области - карта получает кластеры
+
+
+def api_idea_item(idea):
+    """Запись идеи (с полями API_IDEA_FIELDS) -> объект ответа API"""
+    item = {
+        'id': idea.id,
+        'title': idea.title,
+        'description': idea.description,
+        'category': idea.category,
+        'lat': idea.latitude,
+        'lng': idea.longitude,
+        'votes': idea.votes_count,
+        'user': idea.username,
+        'created_at': idea.created_at,
+        'status': idea.status
+    }
+    if idea.image_path:
+        image = idea_image(idea.image_path)
+        item['image_url'] = image['src']
+        item['thumb_url'] = image['thumb']
+    return item
+
+
+def conditional_response(version_names, make_response, variant=''):
+    """Ответ API с сильным ETag, вычисленным из версий данных, номера экземпляра
+    базы (database.DATABASE_EPOCH) и параметров запроса.
+
+    Если клиент прислал совпадающий If-None-Match, возвращается 304 -
+    make_response не вызывается и таблицы с данными не читаются.
+    variant различает представления одного URL (например, по Accept).
+    """
+    versions = database.get_data_versions([*version_names, database.DATABASE_EPOCH])
+    epoch = versions.pop(database.DATABASE_EPOCH)[0]
+    key = '|'.join([request.path, variant, f'epoch={epoch}'] +
+                   [f'{name}={versions[name][0]}' for name in version_names] +
+                   [f'{k}={v}' for k, v in sorted(request.args.items(multi=True))])
+    etag = hashlib.sha1(key.encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response()
+
+    response.set_etag(etag)
+    modified = [updated_at for _, updated_at in versions.values() if updated_at]
+    if modified:
+        response.last_modified = max(modified).replace(tzinfo=timezone.utc)
+    # Кэшировать можно, но перед использованием - сверяться с сервером
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def parse_bbox(value):
+    """'minLng,minLat,maxLng,maxLat' -> кортеж чисел; None, если формат неверный.
+    Координаты за пределами карты прижимаются к ±180/±90, nan и inf не принимаются."""
+    try:
+        bbox = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        return None
+    if len(bbox) != 4 or not all(math.isfinite(v) for v in bbox):
+        return None
+    min_lng, min_lat, max_lng, max_lat = bbox
+    if min_lng > max_lng or min_lat > max_lat:
+        return None
+    lng, lat = lambda v: min(max(v, -180.0), 180.0), lambda v: min(max(v, -90.0), 90.0)
+    return lng(min_lng), lat(min_lat), lng(max_lng), lat(max_lat)
+
+
 @app.route('/api/ideas')
 @login_required
 def api_ideas():
     city_id = request.args.get('city_id', type=int)
     status = request.args.get('status', 'approved')
 
+    bbox = None
+    if request.args.get('bbox'):
+        bbox = parse_bbox(request.args['bbox'])
+        if not bbox:
+            return jsonify({'error': 'bbox должен иметь вид minLng,minLat,maxLng,maxLat'}), 400
+
+    if status not in ['approved', 'implemented']:
+        status = 'approved'
+
+    sort = request.args.get('sort', 'new')
+    if sort not in database.IDEA_SORT_KEYS:
+        sort = 'new'
+
+    # Потоковый режим: все идеи выборки, по одной JSON-записи на строку, без
+    # сборки списка в памяти - клиент может обрабатывать их по мере прихода
+    stream = request.args.get('stream') == '1' or \
+        request.accept_mimetypes.best_match(['application/json', NDJSON_MIME_TYPE]) == NDJSON_MIME_TYPE
+
+    def make_stream():
+        ideas = database.iter_ideas(status=status, city_id=city_id, bbox=bbox, sort=sort,
+                                    q=request.args.get('q', '').strip(),
+                                    after=request.args.get('after'),
+                                    fields=API_IDEA_FIELDS)
+        lines = (app.json.dumps(api_idea_item(idea)) + '\n' for idea in ideas)
+        return Response(stream_with_context(lines), mimetype=NDJSON_MIME_TYPE)
+
+    def make_response():
+        if stream:
+            return make_stream()
+        page = database.get_ideas_page(status=status, city_id=city_id, bbox=bbox, sort=sort,
+                                       q=request.args.get('q', '').strip(),
+                                       after=request.args.get('after'),
+                                       before=request.args.get('before'),
+                                       limit=request.args.get('limit', API_PAGE_SIZE, type=int),
+                                       fields=API_IDEA_FIELDS)
+        return jsonify({
+            'ideas': [api_idea_item(idea) for idea in page['ideas']],
+            'next_cursor': page['next_cursor'],
+            'prev_cursor': page['prev_cursor']
+        })
+
+    response = conditional_response(database.idea_version_names(status, city_id), make_response,
+                                    variant='ndjson' if stream else '')
+    response.vary.add('Accept')
+    return response
+
+
+@app.route('/api/ideas/clusters')
+@login_required
+def api_idea_clusters():
+    city_id = request.args.get('city_id', type=int)
+    status = request.args.get('status', 'approved')
+    zoom = request.args.get('zoom', type=int)
+
+    if status not in ['approved', 'implemented']:
+        status = 'approved'
+
+    # ideas=0: клиент сам загрузит точки из /api/ideas/points
+    include_ideas = request.args.get('ideas', '1') != '0'
+
+    bbox = parse_bbox(request.args.get('bbox', ''))
+    if not bbox or zoom is None:
+        return jsonify({'error': 'Нужны параметры bbox=minLng,minLat,maxLng,maxLat и zoom'}), 400
+
+    def make_response():
+        # На крупном масштабе или когда идей в области немного, кластеры не нужны -
+        # отдаём сами идеи
+        if zoom < database.CLUSTER_MAX_ZOOM:
+            clusters = database.get_map_clusters(zoom, bbox, status=status, city_id=city_id)
+            if sum(c['count'] for c in clusters) > MAP_POINTS_LIMIT:
+                return jsonify({'zoom': zoom, 'clusters': clusters, 'ideas': [], 'points': False})
+
+        ideas = []
+        if include_ideas:
+            ideas = database.get_all_ideas(status=status, city_id=city_id, bbox=bbox,
+                                           limit=API_PAGE_SIZE, fields=API_IDEA_FIELDS)
+        return jsonify({
+            'zoom': zoom,
+            'clusters': [],
+            'ideas': [api_idea_item(idea) for idea in ideas],
+            'points': True
+        })
+
+    return conditional_response(database.idea_version_names(status, city_id), make_response)
+
+
+@app.route('/api/ideas/points')
+@login_required
+def api_idea_points():
+    """Точки для слоя карты в бинарном колоночном формате (см. map_points)"""
+    city_id = request.args.get('city_id', type=int)
+    status = request.args.get('status', 'approved')
+
     if status not in ['approved', 'implemented']:
         status = 'approved'
 
-    ideas = database.get_all_ideas(status=status, city_id=city_id)
-
-    result = []
-    for idea in ideas:
-        item = {
-            'id': idea['id'],
-            'title': idea['title'],
-            'description': idea['description'],
-            'category': idea['category'],
-            'lat': idea['latitude'],
-            'lng': idea['longitude'],
-            'votes': idea['votes_count'],
-            'user': idea['username'],
-            'created_at': idea['created_at'],
-            'status': idea['status']
-        }
-        if idea.get('image_path'):
-            item['image_url'] = f"/static/uploads/{idea['image_path']}"
-        result.append(item)
-
-    return jsonify(result)
+    bbox = None
+    if request.args.get('bbox'):
+        bbox = parse_bbox(request.args['bbox'])
+        if not bbox:
+            return jsonify({'error': 'bbox должен иметь вид minLng,minLat,maxLng,maxLat'}), 400
+
+    def make_response():
+        rows = database.get_idea_points(status=status, city_id=city_id, bbox=bbox)
+        return Response(map_points.encode_points(rows), mimetype=map_points.MIME_TYPE)
+
+    return conditional_response(database.idea_version_names(status, city_id), make_response)
+
+
+@app.route('/api/ideas/<int:idea_id>')
+@login_required
+def api_idea(idea_id):
+    idea = database.get_idea_summary(idea_id, fields=API_IDEA_FIELDS + ('user_id',))
+    if not idea:
+        abort(404)
+
+    if idea['status'] not in ['approved', 'implemented'] and \
+            not current_user.is_admin and current_user.id != idea['user_id']:
+        abort(403)
+
+    return jsonify(api_idea_item(idea))
 
 
 @app.route('/api/cities')
 def api_cities():
-    cities = database.get_all_cities()
-    result = []
-    for city in cities:
-        result.append({
-            'id': city['id'],
-            'name': city['name'],
-            'latitude': city['latitude'],
-            'longitude': city['longitude'],
-            'zoom': city['zoom']
-        })
-    return jsonify(result)
+    def make_response():
+        cities = database.get_all_cities()
+        result = []
+        for city in cities:
+            result.append({
+                'id': city['id'],
+                'name': city['name'],
+                'latitude': city['latitude'],
+                'longitude': city['longitude'],
+                'zoom': city['zoom']
+            })
+        return jsonify(result)
+
+    return conditional_response(['cities'], make_response)
 
 
 @app.route('/stats')
@@ -581,7 +854,13 @@ def login():
         user_data = database.get_user_by_username(username)
 
         if user_data:
-            if check_password_hash(user_data['password_hash'], password):
+            if passwords.verify_password(user_data['password_hash'], password):
+                if passwords.needs_rehash(user_data['password_hash']):
+                    # Параметры хэширования сменились - пересчитываем, пока пароль известен
+                    try:
+                        database.update_password_hash(user_data['id'], passwords.hash_password(password))
+                    except passwords.PasswordHasherBusy:
+                        pass  # пересчитаем при следующем входе
                 user = User(user_data)
                 login_user(user)
                 flash('Вход выполнен успешно!', 'success')
@@ -726,6 +1005,15 @@ def forbidden(e):
     return render_template('403.html'), 403
 
 
+@app.errorhandler(passwords.PasswordHasherBusy)
+def password_hasher_busy(e):
+    # Быстрый отказ вместо очереди входов; клиент может повторить
+    response = app.response_class('Слишком много одновременных входов, повторите попытку через несколько секунд',
+                                  status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = '2'
+    return response
+
+
 if __name__ == '__main__':
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'])
@@ -0,0 +1,465 @@
+"""
+Замеры функций модуля database на синтетических данных.
+
+    python benchmark.py --scale 100k --output bench-100k.json
+    python benchmark.py --scale 100k --compare bench-100k.json
+
+Набор данных создаётся generate_data.py один раз для пары (scale, seed) и
+кэшируется в --data-dir; каждый прогон работает с его копией, так что
+пишущие функции не влияют на следующий прогон. Отчёт - JSON с медианой,
+p95 и минимумом времени, пиковой памятью (tracemalloc, для читающих
+функций) и числом SQL-запросов на вызов; --compare печатает отношение
+медиан и памяти к сохранённому отчёту другого коммита.
+
+    python benchmark.py --scale 100k --mixed-load --profiles default production
+
+--mixed-load вместо замеров отдельных функций запускает смешанную нагрузку
+(чтения страниц и карты, голоса и комментарии) из нескольких процессов с
+потоками - как у сервера с несколькими worker'ами - и сравнивает пропускную
+способность и число ошибок "database is locked" для профилей SQLite
+(см. storage.py).
+
+    python benchmark.py --login-load --pool-sizes 0 2 4
+
+--login-load замеряет входы (хэш пароля) вместе с просмотром страниц при
+разных размерах пула хэширования (см. passwords.py): сколько входов и
+страниц в секунду проходит, сколько входов отклонено с 503 и насколько
+растёт время ответа страниц.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import random
+import platform
+import threading
+import statistics
+import tracemalloc
+import multiprocessing
+import subprocess
+import tempfile
+from datetime import datetime
+
+from generate_data import parse_scale
+
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), 'gorod-idey-bench')
+
+
+def _cases(database, ideas, users, cities):
+    """(имя, функция от номера повтора, пишет ли в базу)"""
+    # Генератор нумерует идеи, пользователей и города подряд после тех,
+    # что создаёт init_db (администратор и три города)
+    idea = lambda i: 1 + (i * 7919) % ideas
+    user = lambda i: 2 + (i * 104729) % users
+    city = lambda i: 4 + i % cities
+    bbox = (86.50, 53.95, 86.70, 54.05)  # центр Киселёвска
+    cursor = database.get_ideas_page(status='approved', limit=100)['next_cursor']
+    from app import app, api_idea_item, API_IDEA_FIELDS
+
+    def api_page(i):
+        # То же, что /api/ideas: выборка, словари API и JSON
+        with app.test_request_context('/api/ideas'):
+            ideas = database.get_all_ideas(status='approved', limit=500, fields=API_IDEA_FIELDS)
+            return app.json.dumps([api_idea_item(idea) for idea in ideas])
+
+    def api_stream(i):
+        with app.test_request_context('/api/ideas'):
+            return sum(len(app.json.dumps(api_idea_item(idea)))
+                       for idea in database.iter_ideas(status='approved', fields=API_IDEA_FIELDS))
+
+    return [
+        ('get_all_ideas', lambda i: database.get_all_ideas(status='approved', limit=20), False),
+        ('get_all_ideas:popular', lambda i: database.get_all_ideas(status='approved', limit=20,
+                                                                   order_by='votes_count DESC'), False),
+        ('get_all_ideas:city', lambda i: database.get_all_ideas(status='approved', city_id=city(i),
+                                                                limit=20), False),
+        ('get_all_ideas:category', lambda i: database.get_all_ideas(status='approved', category='спорт',
+                                                                    limit=20), False),
+        ('get_all_ideas:comments', lambda i: database.get_all_ideas(status='approved', limit=20,
+                                                                    include_comments=True), False),
+        ('get_all_ideas:bbox', lambda i: database.get_all_ideas(status='approved', bbox=bbox, limit=500), False),
+        ('count_ideas', lambda i: database.count_ideas(status='approved', city_id=city(i)), False),
+        ('get_ideas_page', lambda i: database.get_ideas_page(status='approved'), False),
+        ('get_ideas_page:popular', lambda i: database.get_ideas_page(status='approved', sort='popular'), False),
+        ('get_ideas_page:after', lambda i: database.get_ideas_page(status='approved', after=cursor), False),
+        ('get_ideas_page:search', lambda i: database.get_ideas_page(status='approved', q='детская площадка'),
+         False),
+        ('api_ideas:500', api_page, False),
+        ('api_ideas:stream', api_stream, False),
+        ('get_idea_points', lambda i: database.get_idea_points(status='approved', bbox=bbox), False),
+        ('get_map_clusters:z8', lambda i: database.get_map_clusters(8, (84.0, 53.0, 89.0, 57.0)), False),
+        ('get_map_clusters:z13', lambda i: database.get_map_clusters(13, bbox), False),
+        ('get_idea_by_id', lambda i: database.get_idea_by_id(idea(i)), False),
+        ('get_idea_summary', lambda i: database.get_idea_summary(idea(i)), False),
+        ('get_ideas_by_user', lambda i: database.get_ideas_by_user(user(i)), False),
+        ('get_popular_ideas', lambda i: database.get_popular_ideas(limit=3), False),
+        ('get_latest_ideas', lambda i: database.get_latest_ideas(limit=3), False),
+        ('get_comments_by_idea', lambda i: database.get_comments_by_idea(idea(i)), False),
+        ('get_votes_by_idea', lambda i: database.get_votes_by_idea(idea(i)), False),
+        ('get_user_votes', lambda i: database.get_user_votes(user(i)), False),
+        ('get_user_by_id', lambda i: database.get_user_by_id(user(i)), False),
+        ('get_principal', lambda i: database.get_principal(user(i)), False),
+        ('get_user_by_username', lambda i: database.get_user_by_username(f'user{user(i)}'), False),
+        ('get_data_versions', lambda i: database.get_data_versions(database.idea_version_names('approved',
+                                                                                               city(i))), False),
+        ('get_all_cities', lambda i: database.get_all_cities(), False),
+        ('get_city_by_id', lambda i: database.get_city_by_id(city(i)), False),
+        ('get_stats', lambda i: database.get_stats(), False),
+        ('get_user_stats', lambda i: database.get_user_stats(user(i)), False),
+        ('create_user', lambda i: database.create_user(f'bench{i}', f'bench{i}@example.com', 'password'), True),
+        ('create_city', lambda i: database.create_city(f'Замер {i}', '', 54.0, 86.6), True),
+        ('update_city', lambda i: database.update_city(city(i), f'Город {city(i)}', '', 54.0, 86.6, 12, True),
+         True),
+        ('add_vote', lambda i: database.add_vote(user(i), idea(i)), True),
+        ('add_comment', lambda i: database.add_comment('Замер', user(i), idea(i)), True),
+        ('create_idea', lambda i: database.create_idea('Замер', 'Детская площадка во дворе', 'спорт',
+                                                       54.0, 86.6, user(i), city(i)), True),
+        ('update_idea_status', lambda i: database.update_idea_status(
+            idea(i), 'implemented' if i % 2 else 'approved'), True),
+        ('delete_idea', lambda i: database.delete_idea(ideas - i), True),
+    ]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run(repeat, warmup, only=None, log=print):
+    """Замеряет все функции; нужен app context над базой с синтетическими данными"""
+    from sqlalchemy import event, func
+    from sqlalchemy.engine import Engine
+    import database
+    from models import db, Idea, User, City
+
+    ideas = db.session.query(func.max(Idea.id)).scalar()
+    users = db.session.query(func.count(User.id)).scalar() - 1
+    cities = db.session.query(func.count(City.id)).scalar() - 3
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    results = {}
+    # На всех движках: чтения идут через отдельный пул (см. storage.py)
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    try:
+        for name, call, writes in _cases(database, ideas, users, cities):
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            timings = []
+            queries[0] = 0
+            for i in range(warmup + repeat):
+                started = time.perf_counter()
+                call(i)
+                elapsed = time.perf_counter() - started
+                # Как в обработке запроса: сессия не переживает вызов
+                db.session.remove()
+                if i == warmup - 1:
+                    queries[0] = 0
+                if i >= warmup:
+                    timings.append(elapsed * 1000)
+            counted = queries[0]
+            peak = None
+            if not writes:
+                # Пиковый объём памяти за один вызов; отдельно, так как
+                # tracemalloc замедляет выполнение
+                tracemalloc.start()
+                call(warmup + repeat)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                db.session.remove()
+            results[name] = {
+                'median_ms': round(statistics.median(timings), 4),
+                'p95_ms': round(_percentile(timings, 95), 4),
+                'min_ms': round(min(timings), 4),
+                'peak_kib': round(peak / 1024, 1) if peak is not None else None,
+                'queries': round(counted / repeat, 2),
+                'runs': repeat,
+                'writes': writes
+            }
+            log(f"{name:<28} {results[name]['median_ms']:>10.3f} мс  p95 {results[name]['p95_ms']:>10.3f}  "
+                f"память {results[name]['peak_kib'] or 0:>9.1f} КиБ  запросов {results[name]['queries']:g}")
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_query)
+        database.flush_views()
+    return results
+
+
+def _load_thread(deadline, write_ratio, seed, ideas, users, cities, stats):
+    """Цикл одного потока смешанной нагрузки; stats - общий словарь процесса"""
+    from sqlalchemy.exc import OperationalError
+    from app import app
+    import database
+    from models import db
+
+    rng = random.Random(seed)
+    bbox = (86.50, 53.95, 86.70, 54.05)
+    reads = [
+        lambda: database.get_ideas_page(status='approved'),
+        lambda: database.get_ideas_page(status='approved', city_id=4 + rng.randrange(cities), sort='popular'),
+        lambda: database.get_idea_by_id(1 + rng.randrange(ideas)),
+        lambda: database.get_map_clusters(13, bbox),
+        lambda: database.get_stats(),
+    ]
+    writes = [
+        lambda: database.add_vote(2 + rng.randrange(users), 1 + rng.randrange(ideas)),
+        lambda: database.add_comment('Нагрузка', 2 + rng.randrange(users), 1 + rng.randrange(ideas)),
+    ]
+    with app.app_context():
+        while time.perf_counter() < deadline:
+            kind = 'writes' if rng.random() < write_ratio else 'reads'
+            call = rng.choice(writes if kind == 'writes' else reads)
+            started = time.perf_counter()
+            try:
+                call()
+            except OperationalError:
+                db.session.rollback()
+                stats['errors'] += 1
+                continue
+            finally:
+                db.session.remove()
+            stats[kind] += 1
+            stats[kind + '_ms'].append((time.perf_counter() - started) * 1000)
+
+
+def _load_process(database_url, profile, threads, duration, write_ratio, seed, sizes):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['SQLITE_PROFILE'] = profile
+    import database
+
+    stats = {'reads': 0, 'writes': 0, 'errors': 0, 'reads_ms': [], 'writes_ms': []}
+    deadline = time.perf_counter() + duration
+    workers = [threading.Thread(target=_load_thread, args=(deadline, write_ratio, seed * 1000 + i, *sizes, stats))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    database.flush_views()
+    return stats
+
+
+def run_mixed_load(dataset, workdir, profile, processes, threads, duration, write_ratio):
+    """Смешанная нагрузка на копии набора данных с профилем SQLite profile"""
+    working_copy = os.path.join(workdir, f'{profile}.db')
+    shutil.copyfile(dataset, working_copy)
+    conn = sqlite3.connect(working_copy)
+    # Режим журнала хранится в файле: копия начинает с журнала отката,
+    # а WAL включает сам профиль
+    conn.execute('PRAGMA journal_mode = DELETE')
+    ideas, users, cities = conn.execute(
+        'SELECT (SELECT max(id) FROM idea), (SELECT count(*) - 1 FROM user), '
+        '(SELECT count(*) - 3 FROM city)').fetchone()
+    conn.close()
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes) as pool:
+        # Каждый процесс сначала импортирует приложение; нагрузка стартует после
+        parts = pool.starmap(_load_process, [('sqlite:///' + working_copy, profile, threads, duration,
+                                              write_ratio, i + 1, (ideas, users, cities))
+                                             for i in range(processes)])
+
+    reads_ms = [ms for part in parts for ms in part['reads_ms']]
+    writes_ms = [ms for part in parts for ms in part['writes_ms']]
+    total = {kind: sum(part[kind] for part in parts) for kind in ('reads', 'writes', 'errors')}
+    return {
+        'ops_per_s': round((total['reads'] + total['writes']) / duration, 1),
+        'reads_per_s': round(total['reads'] / duration, 1),
+        'writes_per_s': round(total['writes'] / duration, 1),
+        'errors': total['errors'],
+        'read_p50_ms': round(_percentile(reads_ms, 50), 3) if reads_ms else None,
+        'read_p95_ms': round(_percentile(reads_ms, 95), 3) if reads_ms else None,
+        'write_p50_ms': round(_percentile(writes_ms, 50), 3) if writes_ms else None,
+        'write_p95_ms': round(_percentile(writes_ms, 95), 3) if writes_ms else None,
+        'processes': processes,
+        'threads': threads,
+        'duration_s': duration,
+        'write_ratio': write_ratio
+    }
+
+
+def run_login_load(pool_sizes, login_threads, page_threads, duration, log=print):
+    """Входы (POST /login) одновременно с просмотром страниц для каждого
+    размера пула хэширования (0 - хэш в потоке запроса); нужен app context
+    над базой с синтетическими данными"""
+    from sqlalchemy import func
+    from app import app
+    import passwords
+    from models import db, User
+
+    users = db.session.query(func.count(User.id)).scalar() - 1
+    method = app.config['PASSWORD_HASH_METHOD']
+    results = {}
+    for pool_size in pool_sizes:
+        passwords.hasher.shutdown()
+        passwords.hasher.configure(method, pool_size, app.config['PASSWORD_QUEUE_LIMIT'])
+        stats = {'logins': 0, 'rejected': 0, 'pages': 0, 'login_ms': [], 'page_ms': []}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def logins(seed):
+            client = app.test_client()
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                response = client.post('/login', data={'username': f'user{2 + rng.randrange(users)}',
+                                                       'password': 'password'})
+                elapsed = (time.perf_counter() - started) * 1000
+                client.get('/logout')
+                with lock:
+                    if response.status_code == 503:
+                        stats['rejected'] += 1
+                    else:
+                        stats['logins'] += 1
+                        stats['login_ms'].append(elapsed)
+
+        def pages(seed):
+            client = app.test_client()
+            client.post('/login', data={'username': 'user2', 'password': 'password'})
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                client.get('/ideas')
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    stats['pages'] += 1
+                    stats['page_ms'].append(elapsed)
+
+        workers = [threading.Thread(target=logins, args=(i,)) for i in range(login_threads)] + \
+                  [threading.Thread(target=pages, args=(i,)) for i in range(page_threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        name = f'login_load:pool{pool_size}'
+        results[name] = result = {
+            'logins_per_s': round(stats['logins'] / duration, 1),
+            'rejected': stats['rejected'],
+            'pages_per_s': round(stats['pages'] / duration, 1),
+            'login_p95_ms': round(_percentile(stats['login_ms'], 95), 3) if stats['login_ms'] else None,
+            'page_p50_ms': round(_percentile(stats['page_ms'], 50), 3) if stats['page_ms'] else None,
+            'page_p95_ms': round(_percentile(stats['page_ms'], 95), 3) if stats['page_ms'] else None,
+            'pool_size': pool_size,
+            'login_threads': login_threads,
+            'page_threads': page_threads,
+            'duration_s': duration
+        }
+        log(f"{name:<20} входов {result['logins_per_s']:>7.1f}/с (отказов {result['rejected']}), "
+            f"страниц {result['pages_per_s']:>7.1f}/с, p95 страницы {result['page_p95_ms']} мс, "
+            f"p95 входа {result['login_p95_ms']} мс")
+    passwords.hasher.shutdown()
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Печатает медианы текущего отчёта против сохранённого"""
+    print(f"\n{'функция':<28} {'было, мс':>10} {'стало, мс':>10} {'отношение':>10} {'память':>10}")
+    for name, result in report['results'].items():
+        old = baseline['results'].get(name)
+        if not old:
+            print(f"{name:<28} {'-':>10} {result['median_ms']:>10.3f}")
+            continue
+        ratio = result['median_ms'] / old['median_ms'] if old['median_ms'] else float('inf')
+        memory = ''
+        if result.get('peak_kib') and old.get('peak_kib'):
+            memory = f"{result['peak_kib'] / old['peak_kib']:>9.2f}x"
+        print(f"{name:<28} {old['median_ms']:>10.3f} {result['median_ms']:>10.3f} {ratio:>9.2f}x {memory:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры функций database.py на синтетических данных')
+    parser.add_argument('--scale', default='1k', help='Число идей: число или 1k/100k/1M')
+    parser.add_argument('--seed', type=int, default=42, help='Начальное значение генератора данных')
+    parser.add_argument('--repeat', type=int, default=20, help='Число замеряемых вызовов каждой функции')
+    parser.add_argument('--warmup', type=int, default=2, help='Число вызовов перед замером')
+    parser.add_argument('--only', nargs='*', help='Замерять только функции с этими префиксами')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help='Каталог для кэша наборов данных')
+    parser.add_argument('--output', help='Куда записать JSON-отчёт')
+    parser.add_argument('--compare', help='JSON-отчёт другого прогона для сравнения')
+    parser.add_argument('--mixed-load', action='store_true', help='Замер пропускной способности под смешанной нагрузкой')
+    parser.add_argument('--profiles', nargs='+', default=['default', 'production'], help='Профили SQLite для сравнения')
+    parser.add_argument('--processes', type=int, default=4, help='Число процессов нагрузки')
+    parser.add_argument('--threads', type=int, default=4, help='Число потоков в каждом процессе')
+    parser.add_argument('--duration', type=float, default=10.0, help='Длительность нагрузки, с')
+    parser.add_argument('--write-ratio', type=float, default=0.2, help='Доля пишущих операций')
+    parser.add_argument('--login-load', action='store_true',
+                        help='Замер входов вместе с просмотром страниц при разных размерах пула хэширования')
+    parser.add_argument('--pool-sizes', nargs='+', type=int, default=[0, 2],
+                        help='Размеры пула хэширования паролей для сравнения (0 - в потоке запроса)')
+    parser.add_argument('--login-threads', type=int, default=8, help='Число потоков, выполняющих вход')
+    parser.add_argument('--page-threads', type=int, default=4, help='Число потоков, открывающих страницы')
+    args = parser.parse_args()
+
+    ideas = parse_scale(args.scale)
+    os.makedirs(args.data_dir, exist_ok=True)
+    dataset = os.path.join(args.data_dir, f'ideas-{ideas}-seed{args.seed}.db')
+    if not os.path.exists(dataset):
+        if os.path.exists(dataset + '.tmp'):
+            os.remove(dataset + '.tmp')  # остался от прерванной генерации
+        print(f"Генерация набора данных: {ideas} идей...")
+        subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'generate_data.py'),
+                               '--ideas', str(ideas), '--seed', str(args.seed),
+                               '--database', 'sqlite:///' + dataset + '.tmp'])
+        os.replace(dataset + '.tmp', dataset)
+
+    workdir = tempfile.mkdtemp(prefix='bench-', dir=args.data_dir)
+    try:
+        if args.mixed_load:
+            results = {}
+            for profile in args.profiles:
+                results[f'mixed_load:{profile}'] = result = run_mixed_load(
+                    dataset, workdir, profile, args.processes, args.threads, args.duration, args.write_ratio)
+                print(f"{profile:<12} {result['ops_per_s']:>8.1f} оп/с  (чтений {result['reads_per_s']:.1f}, "
+                      f"записей {result['writes_per_s']:.1f}), ошибок {result['errors']}, "
+                      f"p95 чтения {result['read_p95_ms']} мс, записи {result['write_p95_ms']} мс")
+        else:
+            working_copy = os.path.join(workdir, 'database.db')
+            shutil.copyfile(dataset, working_copy)
+            os.environ['DATABASE_URL'] = 'sqlite:///' + working_copy
+            from app import app
+            with app.app_context():
+                if args.login_load:
+                    results = run_login_load(args.pool_sizes, args.login_threads, args.page_threads,
+                                             args.duration)
+                else:
+                    results = run(args.repeat, args.warmup, args.only)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'scale': ideas,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'created_at': datetime.now().isoformat(timespec='seconds')
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✓ Отчёт записан в {args.output}")
+    if args.compare and not args.mixed_load and not args.login_load:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,73 +1,52 @@
 import os
+import re
+import json
+import math
+import time
+import random
+import base64
+import functools
+import atexit
+import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash
-from sqlalchemy import func
-from models import db, User, City, Idea, Vote, Comment
+from sqlalchemy import func, select, tuple_, text, table, column, insert, update, or_, and_, literal, bindparam, \
+    type_coerce, String
+from sqlalchemy.dialects import sqlite, postgresql
+import snowballstemmer
+from models import db, User, City, Idea, Vote, Comment, MapCell, StatCounter, DataVersion
+import images
+import migrations
+import passwords
+from serialization import record, records, record_type, timestamp_text
 
 # ------------------------------------------------------------
-# Вспомогательные функции для преобразования объектов в словари
+# Колонки записей
 # ------------------------------------------------------------
-def user_to_dict(user):
-    if not user:
-        return None
-    return {
-        'id': user.id,
-        'username': user.username,
-        'password_hash': user.password_hash,
-        'email': user.email,
-        'is_admin': user.is_admin,
-        'created_at': user.created_at.strftime('%Y-%m-%d %H:%M:%S') if user.created_at else None
-    }
+# Функции чтения выбирают только нужные колонки и возвращают записи
+# (serialization.record_type) - кортежи с доступом по имени, как у словаря.
+USER_COLUMNS = {
+    'id': User.id,
+    'username': User.username,
+    'password_hash': User.password_hash,
+    'email': User.email,
+    'is_admin': User.is_admin,
+    'created_at': timestamp_text(User.created_at),
+}
 
-def city_to_dict(city):
-    if not city:
-        return None
-    return {
-        'id': city.id,
-        'name': city.name,
-        'description': city.description,
-        'latitude': city.latitude,
-        'longitude': city.longitude,
-        'zoom': city.zoom,
-        'is_active': city.is_active,
-        'created_at': city.created_at.strftime('%Y-%m-%d %H:%M:%S') if city.created_at else None
-    }
+CITY_COLUMNS = {
+    'id': City.id,
+    'name': City.name,
+    'description': City.description,
+    'latitude': City.latitude,
+    'longitude': City.longitude,
+    'zoom': City.zoom,
+    'is_active': City.is_active,
+    'created_at': timestamp_text(City.created_at),
+}
 
-def comment_to_dict(comment):
-    if not comment:
-        return None
-    return {
-        'id': comment.id,
-        'text': comment.text,
-        'user_id': comment.user_id,
-        'username': comment.user.username if comment.user else None,
-        'idea_id': comment.idea_id,
-        'created_at': comment.created_at.strftime('%Y-%m-%d %H:%M:%S') if comment.created_at else None
-    }
-
-def idea_to_dict(idea, include_comments=True):
-    if not idea:
-        return None
-    d = {
-        'id': idea.id,
-        'title': idea.title,
-        'description': idea.description,
-        'category': idea.category,
-        'latitude': idea.latitude,
-        'longitude': idea.longitude,
-        'user_id': idea.user_id,
-        'username': idea.user.username if idea.user else None,
-        'city_id': idea.city_id,
-        'city_name': idea.city.name if idea.city else None,
-        'status': idea.status,
-        'votes_count': idea.votes_count,
-        'views_count': idea.views_count,
-        'created_at': idea.created_at.strftime('%Y-%m-%d %H:%M:%S') if idea.created_at else None,
-        'image_path': idea.image_path,
-    }
-    if include_comments:
-        d['comments'] = [comment_to_dict(c) for c in idea.comments]
-    return d
+COMMENT_FIELDS = ('id', 'text', 'user_id', 'username', 'idea_id', 'created_at')
 
 # ------------------------------------------------------------
 # Инициализация базы данных (создание таблиц и начальных данных)
@@ -75,10 +54,21 @@ def idea_to_dict(idea, include_comments=True):
 def init_db():
     """Создание таблиц и наполнение начальными данными"""
     db.create_all()
+    migrations.upgrade()
+    init_database_epoch()
+    init_spatial_index()
+    init_search_index()
+    if db.session.query(MapCell).first() is None and db.session.query(Idea.id).first() is not None:
+        rebuild_map_cells()
+
+    # Начальные данные добавляются мимо create_user/create_city,
+    # поэтому после них счётчики статистики пересчитываются
+    seeded = False
 
     # Создаём администратора, если нет
     admin = User.query.filter_by(username='admin').first()
     if not admin:
+        seeded = True
         admin = User(username='admin', email='admin@city.ru', is_admin=True)
         admin.set_password('admin123')
         db.session.add(admin)
@@ -94,73 +84,542 @@ def init_db():
                  latitude=53.7557, longitude=87.1094, zoom=12),
         ]
         db.session.add_all(cities)
+        bump_data_versions('cities')
+        seeded = True
+
+    db.session.commit()
+
+    if seeded or db.session.query(StatCounter).first() is None:
+        rebuild_stats()
+
+def reset_db():
+    """Удаляет все таблицы, включая виртуальные и производные, и создаёт
+    базу заново с начальными данными"""
+    drop_search_index()
+    drop_spatial_index()
+    db.drop_all()
+    init_db()
+    _invalidate_city_cache()
+    principal_cache.clear()
+
+# ------------------------------------------------------------
+# Пространственный индекс идей (SQLite R*Tree)
+# ------------------------------------------------------------
+# Виртуальная таблица idea_rtree хранит точку каждой идеи как вырожденный
+# прямоугольник и синхронизируется с таблицей idea триггерами, поэтому
+# её не нужно обновлять вручную ни в одной функции этого модуля.
+# На других СУБД запрос по области работает обычным фильтром по координатам.
+idea_rtree = table('idea_rtree', column('id'), column('min_lng'), column('max_lng'),
+                   column('min_lat'), column('max_lat'))
+
+SPATIAL_INDEX_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS idea_rtree_insert AFTER INSERT ON idea BEGIN
+        INSERT OR REPLACE INTO idea_rtree
+        VALUES (new.id, new.longitude, new.longitude, new.latitude, new.latitude);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS idea_rtree_update AFTER UPDATE OF latitude, longitude ON idea BEGIN
+        INSERT OR REPLACE INTO idea_rtree
+        VALUES (new.id, new.longitude, new.longitude, new.latitude, new.latitude);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS idea_rtree_delete AFTER DELETE ON idea BEGIN
+        DELETE FROM idea_rtree WHERE id = old.id;
+    END""",
+]
+
+def has_spatial_index():
+    return db.engine.dialect.name == 'sqlite'
+
+def init_spatial_index():
+    """Создаёт R*Tree и триггеры; для существующей базы заполняет индекс"""
+    if not has_spatial_index():
+        return
+    exists = db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'idea_rtree'")).first()
+    if not exists:
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE idea_rtree USING rtree(id, min_lng, max_lng, min_lat, max_lat)"))
+        db.session.execute(text(
+            "INSERT INTO idea_rtree SELECT id, longitude, longitude, latitude, latitude FROM idea"))
+    for ddl in SPATIAL_INDEX_DDL:
+        db.session.execute(text(ddl))
+    db.session.commit()
+
+def drop_spatial_index():
+    """Удаляет idea_rtree (триггеры удаляются вместе с таблицей idea)"""
+    if has_spatial_index():
+        db.session.execute(text("DROP TABLE IF EXISTS idea_rtree"))
+        db.session.commit()
+
+def _filter_bbox(query, bbox):
+    """bbox = (min_lng, min_lat, max_lng, max_lat)"""
+    min_lng, min_lat, max_lng, max_lat = bbox
+    if has_spatial_index():
+        # R*Tree хранит координаты во float32 с округлением наружу,
+        # поэтому он только отбирает кандидатов, точная проверка - ниже
+        candidates = select(idea_rtree.c.id).where(
+            idea_rtree.c.max_lng >= min_lng, idea_rtree.c.min_lng <= max_lng,
+            idea_rtree.c.max_lat >= min_lat, idea_rtree.c.min_lat <= max_lat)
+        query = query.filter(Idea.id.in_(candidates))
+    return query.filter(Idea.longitude.between(min_lng, max_lng),
+                        Idea.latitude.between(min_lat, max_lat))
+
+# ------------------------------------------------------------
+# Полнотекстовый поиск (SQLite FTS5)
+# ------------------------------------------------------------
+# idea_fts хранит не исходный текст, а основы слов (стеммер Snowball для
+# русского языка), так что "велосипедные дорожки" находится по запросу
+# "дорожка для велосипеда". Запрос стеммится так же. Индекс обновляется
+# в create_idea/delete_idea (название и описание идеи не редактируются).
+# На других СУБД поиск идёт через ILIKE по тем же основам.
+_stemmers = threading.local()
+
+# Стеммер написан на чистом Python (~0.1 мс на слово), а словарь текстов
+# невелик - основы кэшируются
+@functools.lru_cache(maxsize=100000)
+def _stem_word(word):
+    stemmer = getattr(_stemmers, 'russian', None)
+    if stemmer is None:
+        stemmer = _stemmers.russian = snowballstemmer.stemmer('russian')
+    return stemmer.stemWord(word)
+
+def _stem_words(text):
+    words = re.findall(r'\w+', (text or '').lower().replace('ё', 'е'))
+    return [_stem_word(word) for word in words]
+
+def has_search_index():
+    return db.engine.dialect.name == 'sqlite'
+
+def _index_idea_text(idea_id, title, description):
+    if has_search_index():
+        db.session.execute(text("INSERT INTO idea_fts (rowid, title, description) VALUES (:id, :title, :description)"),
+                           {'id': idea_id, 'title': ' '.join(_stem_words(title)),
+                            'description': ' '.join(_stem_words(description))})
+
+def _unindex_idea_text(idea_id):
+    if has_search_index():
+        db.session.execute(text("DELETE FROM idea_fts WHERE rowid = :id"), {'id': idea_id})
+
+def init_search_index():
+    """Создаёт idea_fts; для существующей базы индексирует все идеи"""
+    if not has_search_index():
+        return
+    exists = db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'idea_fts'")).first()
+    if exists:
+        return
+    db.session.execute(text("CREATE VIRTUAL TABLE idea_fts USING fts5(title, description)"))
+    rebuild_search_index()
+
+def drop_search_index():
+    """Удаляет idea_fts: db.drop_all() виртуальные таблицы не видит"""
+    if has_search_index():
+        db.session.execute(text("DROP TABLE IF EXISTS idea_fts"))
+        db.session.commit()
+
+def rebuild_search_index():
+    """Индексирует заново все идеи - после загрузки данных мимо create_idea"""
+    if not has_search_index():
+        return 0
+    db.session.execute(text("DELETE FROM idea_fts"))
+    count = 0
+    batch = []
+    rows = db.session.query(Idea.id, Idea.title, Idea.description).yield_per(5000)
+    for idea_id, title, description in rows:
+        batch.append({'id': idea_id, 'title': ' '.join(_stem_words(title)),
+                      'description': ' '.join(_stem_words(description))})
+        if len(batch) >= 5000:
+            db.session.execute(text("INSERT INTO idea_fts (rowid, title, description) "
+                                    "VALUES (:id, :title, :description)"), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(text("INSERT INTO idea_fts (rowid, title, description) "
+                                "VALUES (:id, :title, :description)"), batch)
+        count += len(batch)
+    db.session.commit()
+    return count
+
+def _search_subquery(q):
+    """Подзапрос (rowid, rank) с идеями, подходящими под запрос q;
+    None, если в запросе нет ни одного слова. Меньший rank - лучше."""
+    stems = _stem_words(q)
+    if not stems:
+        return None
+    if has_search_index():
+        # Каждая основа в кавычках и с * (совпадение по префиксу основы);
+        # слова объединяются через AND. bm25 с весом 2 для названия.
+        match = ' '.join(f'"{stem}"*' for stem in stems)
+        return text("SELECT rowid, bm25(idea_fts, 2.0, 1.0) AS rank FROM idea_fts WHERE idea_fts MATCH :match") \
+            .bindparams(match=match) \
+            .columns(rowid=db.Integer, rank=db.Float) \
+            .subquery('search')
+    conditions = [or_(Idea.title.ilike(f'%{stem}%'), Idea.description.ilike(f'%{stem}%')) for stem in stems]
+    return select(Idea.id.label('rowid'), literal(0.0).label('rank')).where(and_(*conditions)).subquery('search')
+
+# ------------------------------------------------------------
+# Сетка кластеров карты
+# ------------------------------------------------------------
+# Для каждого уровня масштаба карта делится на ячейки (тайл Web Mercator,
+# разбитый на 4x4, т.е. ~64px на экране). В map_cell для каждой ячейки
+# хранится число идей по статусу/категории/городу и сумма координат, так что
+# кластеры для любой видимой области читаются из готовых агрегатов.
+# Ячейки обновляются при создании идеи, смене статуса и удалении.
+CLUSTER_MAX_ZOOM = 16  # начиная с этого масштаба карта получает сами идеи
+CELL_BITS = 2
+MAX_MERCATOR_LAT = 85.05112878
+
+def _cell_xy(latitude, longitude, level):
+    n = 1 << (level + CELL_BITS)
+    lat = math.radians(max(min(latitude, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT))
+    x = int((longitude + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def _map_cell_keys(latitude, longitude, status, category, city_id):
+    for level in range(CLUSTER_MAX_ZOOM):
+        cell_x, cell_y = _cell_xy(latitude, longitude, level)
+        yield (level, cell_x, cell_y, status, category, city_id or 0)
+
+def _dialect_insert(model):
+    """INSERT с поддержкой ON CONFLICT для текущей СУБД"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(model)
+    if dialect == 'postgresql':
+        return postgresql.insert(model)
+    raise NotImplementedError(f'ON CONFLICT не поддерживается для {dialect}')
+
+def _upsert(model, rows, increment, assign=()):
+    """INSERT ... ON CONFLICT DO UPDATE с прибавлением колонок increment
+    и заменой колонок assign. Один запрос на все строки (executemany):
+    оператор компилируется один раз, сколько бы строк ни было."""
+    if not rows:
+        return
+    table = model.__table__
+    stmt = _dialect_insert(table)
+    pk = [c.name for c in table.primary_key.columns]
+    set_ = {c: table.c[c] + getattr(stmt.excluded, c) for c in increment}
+    set_.update({c: getattr(stmt.excluded, c) for c in assign})
+    stmt = stmt.on_conflict_do_update(index_elements=pk, set_=set_)
+    db.session.execute(stmt, rows)
+
+def _add_to_map_cells(cells, latitude, longitude, status, category, city_id, delta=1):
+    """Учитывает идею в словаре {ключ ячейки: [число, сумма широт, сумма долгот]}"""
+    if latitude is None or longitude is None or not status:
+        return
+    for key in _map_cell_keys(latitude, longitude, status, category, city_id):
+        cell = cells.setdefault(key, [0, 0.0, 0.0])
+        cell[0] += delta
+        cell[1] += delta * latitude
+        cell[2] += delta * longitude
+
+def _map_cell_rows(cells):
+    for (level, cell_x, cell_y, status, category, city_id), (count, sum_lat, sum_lng) in cells.items():
+        yield dict(level=level, cell_x=cell_x, cell_y=cell_y, status=status, category=category,
+                   city_id=city_id, count=count, sum_lat=sum_lat, sum_lng=sum_lng)
+
+def _shift_map_cells(latitude, longitude, status, category, city_id, delta):
+    """Добавляет (delta=1) или убирает (delta=-1) идею из ячеек всех уровней.
+    Не коммитит: вызывается внутри транзакции изменения идеи."""
+    if latitude is None or longitude is None or not status:
+        return
+    keys = list(_map_cell_keys(latitude, longitude, status, category, city_id))
+    rows = [dict(level=k[0], cell_x=k[1], cell_y=k[2], status=k[3], category=k[4], city_id=k[5],
+                 count=delta, sum_lat=delta * latitude, sum_lng=delta * longitude)
+            for k in keys]
+    _upsert(MapCell, rows, ('count', 'sum_lat', 'sum_lng'))
+    if delta < 0:
+        _delete_empty_map_cells(keys)
+
+def _delete_empty_map_cells(keys, batch_size=500):
+    """Удаляет ячейки из keys, в которых не осталось идей"""
+    pk = tuple_(MapCell.level, MapCell.cell_x, MapCell.cell_y,
+                MapCell.status, MapCell.category, MapCell.city_id)
+    for start in range(0, len(keys), batch_size):
+        MapCell.query.filter(pk.in_(keys[start:start + batch_size]), MapCell.count <= 0) \
+                     .delete(synchronize_session=False)
+
+def rebuild_map_cells():
+    """Пересчитывает всю сетку кластеров с нуля по таблице idea"""
+    cells = {}
+    rows = db.session.query(Idea.latitude, Idea.longitude, Idea.status, Idea.category, Idea.city_id) \
+                     .yield_per(5000)
+    for latitude, longitude, status, category, city_id in rows:
+        _add_to_map_cells(cells, latitude, longitude, status, category, city_id)
 
+    MapCell.query.delete()
+    batch = []
+    for row in _map_cell_rows(cells):
+        batch.append(row)
+        if len(batch) >= 5000:
+            db.session.execute(insert(MapCell), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(MapCell), batch)
     db.session.commit()
+    return len(cells)
+
+def get_map_clusters(zoom, bbox, status='approved', city_id=None):
+    """Кластеры видимой области для масштаба zoom.
+
+    Возвращает список {'lat', 'lng', 'count', 'categories': {категория: число}},
+    где lat/lng - центроид идей ячейки.
+    """
+    level = max(0, min(int(zoom), CLUSTER_MAX_ZOOM - 1))
+    min_lng, min_lat, max_lng, max_lat = bbox
+    x0, y0 = _cell_xy(max_lat, min_lng, level)
+    x1, y1 = _cell_xy(min_lat, max_lng, level)
+
+    query = db.session.query(MapCell.cell_x, MapCell.cell_y, MapCell.category,
+                             func.sum(MapCell.count), func.sum(MapCell.sum_lat), func.sum(MapCell.sum_lng)) \
+                      .filter(MapCell.level == level, MapCell.status == status,
+                              MapCell.cell_x.between(x0, x1), MapCell.cell_y.between(y0, y1),
+                              MapCell.count > 0)
+    if city_id:
+        query = query.filter(MapCell.city_id == city_id)
+    query = query.group_by(MapCell.cell_x, MapCell.cell_y, MapCell.category)
+
+    clusters = {}
+    for cell_x, cell_y, category, count, sum_lat, sum_lng in query.all():
+        cluster = clusters.setdefault((cell_x, cell_y), {'count': 0, 'sum_lat': 0.0, 'sum_lng': 0.0,
+                                                         'categories': {}})
+        cluster['count'] += count
+        cluster['sum_lat'] += sum_lat
+        cluster['sum_lng'] += sum_lng
+        cluster['categories'][category] = count
+
+    return [{'lat': c['sum_lat'] / c['count'],
+             'lng': c['sum_lng'] / c['count'],
+             'count': c['count'],
+             'categories': c['categories']}
+            for c in clusters.values()]
 
 # ------------------------------------------------------------
 # Пользователи
 # ------------------------------------------------------------
 def create_user(username, email, password):
+    # Хэш считается в пуле процессов (см. passwords.py); PasswordHasherBusy
+    # уходит вызывающему
+    password_hash = passwords.hash_password(password)
     try:
-        user = User(username=username, email=email)
-        user.set_password(password)
+        user = User(username=username, email=email, password_hash=password_hash)
         db.session.add(user)
+        _bump_counters([('users', '', 1)])
         db.session.commit()
         return user.id
     except Exception:
         db.session.rollback()
         return None
 
+def _user_query():
+    return db.session.query(*USER_COLUMNS.values())
+
 def get_user_by_username(username):
-    user = User.query.filter_by(username=username).first()
-    return user_to_dict(user)
+    return record(USER_COLUMNS, _user_query().filter(User.username == username).first())
 
 def get_user_by_id(user_id):
-    user = User.query.get(user_id)
-    return user_to_dict(user)
+    return record(USER_COLUMNS, _user_query().filter(User.id == user_id).first())
+
+def update_password_hash(user_id, password_hash):
+    User.query.filter_by(id=user_id).update({'password_hash': password_hash})
+    db.session.commit()
+
+def set_user_admin(user_id, is_admin):
+    updated = User.query.filter_by(id=user_id).update({'is_admin': bool(is_admin)})
+    if updated:
+        # Остальные процессы сбросят кэш пользователей по версии
+        bump_data_versions('users')
+    db.session.commit()
+    if updated:
+        principal_cache.clear()
+    return bool(updated)
+
+# ------------------------------------------------------------
+# Кэш пользователей для Flask-Login
+# ------------------------------------------------------------
+# load_user вызывается на каждом запросе авторизованного пользователя
+# (внутри запроса Flask-Login сам запоминает результат). Поэтому
+# пользователи кэшируются в памяти процесса: до USER_CACHE_SIZE записей
+# без хэша пароля, каждая живёт не дольше USER_CACHE_TTL секунд. Изменение
+# пользователя увеличивает версию 'users' в data_version; процессы сверяют
+# её не чаще раза в USER_VERSION_TTL секунд и при расхождении сбрасывают
+# кэш. Обычно запрос авторизованного пользователя не читает таблицу user.
+PRINCIPAL_FIELDS = ('id', 'username', 'email', 'is_admin')
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300.0
+USER_VERSION_TTL = 2.0
+
+class PrincipalCache:
+    """LRU-кэш записей пользователей с ограничением по времени жизни"""
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, version_ttl=USER_VERSION_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self._entries = OrderedDict()  # id -> (запись, время загрузки)
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def _check_version(self, now):
+        if self._version is not None and now - self._checked_at < self.version_ttl:
+            return
+        version = get_data_version('users')
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._checked_at = now
+
+    def get(self, user_id):
+        now = time.monotonic()
+        self._check_version(now)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                return entry[0]
+
+        columns = [USER_COLUMNS[f] for f in PRINCIPAL_FIELDS]
+        principal = record(PRINCIPAL_FIELDS, db.session.query(*columns).filter(User.id == user_id).first())
+        if principal is not None:
+            with self._lock:
+                self._entries[user_id] = (principal, now)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return principal
+
+principal_cache = PrincipalCache()
+
+def get_principal(user_id):
+    """Пользователь для Flask-Login: id, username, email, is_admin (без хэша пароля)"""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    return principal_cache.get(user_id)
+
+# ------------------------------------------------------------
+# Версии данных
+# ------------------------------------------------------------
+def get_data_version(name):
+    return db.session.query(DataVersion.version).filter_by(name=name).scalar() or 0
+
+def get_data_versions(names):
+    """{name: (версия, время изменения)} одним запросом; отсутствующие - (0, None)"""
+    rows = db.session.query(DataVersion.name, DataVersion.version, DataVersion.updated_at) \
+                     .filter(DataVersion.name.in_(names)).all()
+    versions = {name: (0, None) for name in names}
+    versions.update({name: (version, updated_at) for name, version, updated_at in rows})
+    return versions
+
+# Случайный номер экземпляра базы. Создаётся вместе с базой (и заново при
+# сбросе): версии новой базы начинаются с нуля, и номер не даёт ETag'ам
+# совпасть с выданными для прежней.
+DATABASE_EPOCH = 'database_epoch'
+
+def init_database_epoch():
+    stmt = _dialect_insert(DataVersion).values(name=DATABASE_EPOCH, version=random.randrange(1, 2 ** 31)) \
+                                       .on_conflict_do_nothing(index_elements=['name'])
+    db.session.execute(stmt)
+    db.session.commit()
+
+def bump_data_versions(*names):
+    """Увеличивает версии в текущей транзакции (коммит - за вызывающим)"""
+    now = datetime.utcnow()
+    _upsert(DataVersion, [dict(name=name, version=1, updated_at=now) for name in set(names)],
+            ('version',), assign=('updated_at',))
+
+def idea_version_names(status, city_id=None):
+    """Версии, от которых зависят списки идей данного статуса (всех городов и города city_id)"""
+    names = [f'ideas:{status}']
+    if city_id:
+        names.append(f'ideas:{status}:{city_id}')
+    return names
 
 # ------------------------------------------------------------
 # Города
 # ------------------------------------------------------------
+# Справочник городов меняется только из админки, а читается почти на каждой
+# странице, поэтому он кэшируется в памяти процесса. Изменения увеличивают
+# версию 'cities' в data_version; другие процессы сверяют её не чаще раза
+# в CITY_CACHE_TTL секунд, так что обычно чтение городов не делает запросов.
+CITY_CACHE_TTL = 2.0
+
+_city_cache = {'version': None, 'checked_at': 0.0, 'cities': [], 'by_id': {}}
+
+def _invalidate_city_cache():
+    _city_cache['version'] = None
+
+def _cached_cities():
+    now = time.monotonic()
+    if _city_cache['version'] is not None and now - _city_cache['checked_at'] < CITY_CACHE_TTL:
+        return _city_cache
+    # Версия читается до городов: если город изменят между двумя запросами,
+    # кэш получит старую версию и перечитается при следующей проверке
+    version = get_data_version('cities')
+    if version != _city_cache['version']:
+        cities = records(CITY_COLUMNS, db.session.query(*CITY_COLUMNS.values()).order_by(City.name).all())
+        _city_cache.update(cities=cities, by_id={c['id']: c for c in cities}, version=version)
+    _city_cache['checked_at'] = now
+    return _city_cache
+
 def get_all_cities(active_only=True):
-    query = City.query
+    cities = _cached_cities()['cities']
     if active_only:
-        query = query.filter_by(is_active=True)
-    cities = query.order_by(City.name).all()
-    return [city_to_dict(c) for c in cities]
+        return [c for c in cities if c['is_active']]
+    return list(cities)
 
 def get_city_by_id(city_id):
-    city = City.query.get(city_id)
-    return city_to_dict(city)
+    return _cached_cities()['by_id'].get(city_id)
 
 def create_city(name, description, latitude, longitude, zoom=12, is_active=True):
     try:
         city = City(name=name, description=description, latitude=latitude,
                     longitude=longitude, zoom=zoom, is_active=is_active)
         db.session.add(city)
+        if is_active:
+            _bump_counters([('active_cities', '', 1)])
+        bump_data_versions('cities')
         db.session.commit()
         return city.id
     except Exception:
         db.session.rollback()
         return None
+    finally:
+        _invalidate_city_cache()
 
 def update_city(city_id, name, description, latitude, longitude, zoom, is_active):
     city = City.query.get(city_id)
     if not city:
         return
+    if bool(city.is_active) != bool(is_active):
+        _bump_counters([('active_cities', '', 1 if is_active else -1)])
     city.name = name
     city.description = description
     city.latitude = latitude
     city.longitude = longitude
     city.zoom = zoom
     city.is_active = is_active
+    bump_data_versions('cities')
     db.session.commit()
+    _invalidate_city_cache()
 
 def delete_city(city_id):
     city = City.query.get(city_id)
     if city:
+        if city.is_active:
+            _bump_counters([('active_cities', '', -1)])
         db.session.delete(city)
+        bump_data_versions('cities')
         db.session.commit()
+        _invalidate_city_cache()
 
 # ------------------------------------------------------------
 # Идеи
@@ -172,20 +631,151 @@ def create_idea(title, description, category, latitude, longitude, user_id, city
         user_id=user_id, city_id=city_id, image_path=image_path
     )
     db.session.add(idea)
+    db.session.flush()
+    _index_idea_text(idea.id, title, description)
+    _shift_map_cells(idea.latitude, idea.longitude, idea.status, idea.category, idea.city_id, 1)
+    _bump_counters(_idea_counters(idea.status, idea.category, idea.city_id, idea.user_id,
+                                  idea.created_at, 1))
+    bump_data_versions(*idea_version_names(idea.status, idea.city_id))
     db.session.commit()
     return idea.id
 
-def get_all_ideas(status=None, category=None, city_id=None, user_id=None,
-                  limit=None, offset=0, order_by='created_at DESC'):
-    query = Idea.query
+IDEA_STATUSES = ('pending', 'approved', 'rejected', 'implemented')
+
+def create_ideas(ideas):
+    """create_idea для пачки идей (импорт): ideas - словари с полями Idea.
+
+    Идеи вставляются одним executemany, а полнотекстовый индекс, ячейки карты,
+    счётчики и версии обновляются по всей пачке сразу - агрегированными
+    запросами, а не по запросу на идею. Один коммит на пачку.
+    Возвращает id новых идей в порядке ideas."""
+    if not ideas:
+        return []
+    now = datetime.utcnow()
+    rows = [dict(title=idea['title'], description=idea['description'], category=idea['category'],
+                 latitude=idea['latitude'], longitude=idea['longitude'], user_id=idea['user_id'],
+                 city_id=idea.get('city_id'), status=idea.get('status') or 'pending',
+                 votes_count=0, views_count=0, created_at=idea.get('created_at') or now,
+                 image_path=idea.get('image_path'))
+            for idea in ideas]
+    ids = db.session.scalars(insert(Idea).returning(Idea.id, sort_by_parameter_order=True), rows).all()
+
+    if has_search_index():
+        db.session.execute(text("INSERT INTO idea_fts (rowid, title, description) "
+                                "VALUES (:id, :title, :description)"),
+                           [{'id': idea_id, 'title': ' '.join(_stem_words(row['title'])),
+                             'description': ' '.join(_stem_words(row['description']))}
+                            for idea_id, row in zip(ids, rows)])
+    cells = {}
+    counters = []
+    names = set()
+    for row in rows:
+        _add_to_map_cells(cells, row['latitude'], row['longitude'], row['status'], row['category'],
+                          row['city_id'])
+        counters += _idea_counters(row['status'], row['category'], row['city_id'], row['user_id'],
+                                   row['created_at'], 1)
+        names.update(idea_version_names(row['status'], row['city_id']))
+    _upsert(MapCell, list(_map_cell_rows(cells)), ('count', 'sum_lat', 'sum_lng'))
+    _bump_counters(counters)
+    bump_data_versions(*names)
+    db.session.commit()
+    return ids
+
+EXCERPT_LENGTH = 200
+
+# Колонки, из которых собирается строка списка идей. Автор и город
+# подтягиваются join'ами, число комментариев - коррелированным подзапросом,
+# поэтому список любой длины читается одним запросом. Дата создания
+# форматируется самим запросом; created_key - она же без форматирования,
+# для курсоров; excerpt - начало описания для коротких списков.
+IDEA_LIST_COLUMNS = {
+    'id': Idea.id,
+    'title': Idea.title,
+    'description': Idea.description,
+    'category': Idea.category,
+    'latitude': Idea.latitude,
+    'longitude': Idea.longitude,
+    'user_id': Idea.user_id,
+    'username': User.username,
+    'city_id': Idea.city_id,
+    'city_name': City.name,
+    'status': Idea.status,
+    'votes_count': Idea.votes_count,
+    'views_count': Idea.views_count,
+    'created_at': timestamp_text(Idea.created_at),
+    'created_key': type_coerce(Idea.created_at, String),
+    'image_path': Idea.image_path,
+    'excerpt': func.substr(Idea.description, 1, EXCERPT_LENGTH),
+    'comments_count': select(func.count(Comment.id))
+                        .where(Comment.idea_id == Idea.id)
+                        .correlate(Idea)
+                        .scalar_subquery(),
+}
+
+IDEA_LIST_FIELDS = tuple(k for k in IDEA_LIST_COLUMNS if k not in ('comments_count', 'created_key', 'excerpt'))
+
+def _comments_by_idea(idea_ids):
+    """Комментарии для набора идей одним запросом (вместе с именами авторов)"""
+    result = {idea_id: [] for idea_id in idea_ids}
+    if not idea_ids:
+        return result
+    rows = db.session.query(Comment.id, Comment.text, Comment.user_id, User.username,
+                            Comment.idea_id, timestamp_text(Comment.created_at)) \
+                     .outerjoin(User, Comment.user_id == User.id) \
+                     .filter(Comment.idea_id.in_(idea_ids)) \
+                     .order_by(Comment.created_at, Comment.id).all()
+    for comment in records(COMMENT_FIELDS, rows):
+        result[comment.idea_id].append(comment)
+    return result
+
+def _filter_ideas(query, status=None, category=None, city_id=None, user_id=None, bbox=None):
     if status:
-        query = query.filter_by(status=status)
+        query = query.filter(Idea.status == status)
     if category and category != 'all':
-        query = query.filter_by(category=category)
+        query = query.filter(Idea.category == category)
     if city_id:
-        query = query.filter_by(city_id=city_id)
+        query = query.filter(Idea.city_id == city_id)
     if user_id:
-        query = query.filter_by(user_id=user_id)
+        query = query.filter(Idea.user_id == user_id)
+    if bbox:
+        query = _filter_bbox(query, bbox)
+    return query
+
+def _idea_list_query(fields, status=None, category=None, city_id=None, user_id=None, bbox=None):
+    columns = [IDEA_LIST_COLUMNS[f].label(f) for f in fields]
+    query = db.session.query(*columns).select_from(Idea)
+    if 'username' in fields:
+        query = query.outerjoin(User, Idea.user_id == User.id)
+    if 'city_name' in fields:
+        query = query.outerjoin(City, Idea.city_id == City.id)
+    return _filter_ideas(query, status, category, city_id, user_id, bbox)
+
+def _list_fields(fields, *required):
+    fields = list(fields or IDEA_LIST_FIELDS)
+    for f in required:
+        if f not in fields:
+            fields.append(f)
+    return fields
+
+def _rows_to_records(fields, rows, include_comments=False):
+    if not include_comments:
+        return records(fields, rows)
+    # Комментарии - последним полем записи
+    id_idx = fields.index('id')
+    comments = _comments_by_idea([row[id_idx] for row in rows])
+    return records(list(fields) + ['comments'], [(*row, comments[row[id_idx]]) for row in rows])
+
+def get_all_ideas(status=None, category=None, city_id=None, user_id=None,
+                  limit=None, offset=0, order_by='created_at DESC',
+                  fields=None, include_comments=False, bbox=None):
+    """Список идей в виде словарей.
+
+    fields - какие ключи нужны вызывающему (по умолчанию IDEA_LIST_FIELDS),
+    include_comments - подгрузить комментарии (одним дополнительным запросом),
+    bbox - только идеи внутри (min_lng, min_lat, max_lng, max_lat).
+    """
+    fields = _list_fields(fields, *(['id'] if include_comments else []))
+    query = _idea_list_query(fields, status, category, city_id, user_id, bbox)
 
     # Обработка сортировки
     if order_by:
@@ -200,43 +790,291 @@ def get_all_ideas(status=None, category=None, city_id=None, user_id=None,
     if limit:
         query = query.limit(limit).offset(offset)
 
-    ideas = query.all()
-    return [idea_to_dict(i, include_comments=True) for i in ideas]
+    return _rows_to_records(fields, query.all(), include_comments)
+
+def count_ideas(status=None, category=None, city_id=None, user_id=None, bbox=None):
+    query = db.session.query(func.count(Idea.id))
+    return _filter_ideas(query, status, category, city_id, user_id, bbox).scalar()
+
+# ------------------------------------------------------------
+# Постраничный вывод по курсору (keyset pagination)
+# ------------------------------------------------------------
+# Страница задаётся не смещением, а позицией последней показанной идеи
+# (ключ сортировки, id), поэтому стоимость запроса не зависит от номера
+# страницы. Курсор для клиента непрозрачен: это base64 от JSON.
+IDEA_SORT_KEYS = {
+    'new': 'created_at',
+    'popular': 'votes_count',
+}
+# Поле строки, из которого берётся значение ключа для курсора
+IDEA_CURSOR_FIELDS = {
+    'created_at': 'created_key',
+    'votes_count': 'votes_count',
+}
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 500
+
+def _pack_cursor(value):
+    raw = json.dumps(value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def _unpack_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    return json.loads(raw)
+
+def encode_cursor(sort_value, idea_id):
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    return _pack_cursor([sort_value, idea_id])
+
+# Диапазон INTEGER в SQLite: значения за его пределами не привязываются к запросу
+SQLITE_INT_MIN, SQLITE_INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+def _cursor_int(value, integral=True):
+    """Число из курсора, проверенное до привязки к запросу: только int (или
+    конечный float при integral=False) в диапазоне INTEGER SQLite"""
+    if isinstance(value, bool) or not isinstance(value, int if integral else (int, float)):
+        raise ValueError('not a number')
+    # nan и inf в диапазон тоже не попадают
+    if not SQLITE_INT_MIN <= value <= SQLITE_INT_MAX:
+        raise ValueError('out of range')
+    return int(value)
+
+def decode_cursor(cursor, sort='new'):
+    """Возвращает (значение ключа, id) или None для битого курсора"""
+    if not cursor:
+        return None
+    try:
+        sort_value, idea_id = _unpack_cursor(cursor)
+        if IDEA_SORT_KEYS.get(sort, 'created_at') == 'created_at':
+            if not isinstance(sort_value, str):
+                return None
+            sort_value = datetime.fromisoformat(sort_value)
+        else:
+            sort_value = _cursor_int(sort_value, integral=False)
+        return sort_value, _cursor_int(idea_id)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+# Дальше этого смещения поиск не листается: OFFSET всё равно читает все
+# пропущенные строки, а релевантные результаты - в начале выдачи
+MAX_SEARCH_OFFSET = 10000
+
+def _decode_offset_cursor(cursor):
+    """Смещение из курсора поиска; 0 для битого курсора"""
+    try:
+        tag, offset = _unpack_cursor(cursor)
+    except (ValueError, TypeError, OverflowError):
+        return 0
+    if tag != 'o' or isinstance(offset, bool) or not isinstance(offset, int):
+        return 0
+    return min(max(offset, 0), MAX_SEARCH_OFFSET)
+
+def _search_page(search, fields, query, after, before, limit, include_comments):
+    """Страница результатов поиска: порядок по релевантности (bm25), при
+    равенстве - по голосам. Релевантность зависит от всего индекса, поэтому
+    курсор здесь хранит смещение, а не позицию."""
+    if after:
+        offset = _decode_offset_cursor(after)
+    elif before:
+        offset = max(_decode_offset_cursor(before) - limit, 0)
+    else:
+        offset = 0
+
+    rows = query.join(search, search.c.rowid == Idea.id) \
+                .order_by(search.c.rank, Idea.votes_count.desc(), Idea.id.desc()) \
+                .offset(offset).limit(limit + 1).all()
+    has_more = len(rows) > limit and offset + limit <= MAX_SEARCH_OFFSET
+    rows = rows[:limit]
+
+    return {'ideas': _rows_to_records(fields, rows, include_comments),
+            'next_cursor': _pack_cursor(['o', offset + limit]) if has_more else None,
+            'prev_cursor': _pack_cursor(['o', offset]) if offset else None}
+
+def get_ideas_page(status=None, category=None, city_id=None, user_id=None,
+                   sort='new', after=None, before=None, limit=PAGE_SIZE,
+                   fields=None, include_comments=False, bbox=None, q=None):
+    """Одна страница идей по курсору.
+
+    after/before - курсоры из предыдущего ответа (next_cursor/prev_cursor),
+    q - поисковый запрос (тогда сортировка по релевантности, sort не учитывается).
+    Возвращает {'ideas': [...], 'next_cursor': ..., 'prev_cursor': ...}.
+    """
+    key_name = IDEA_SORT_KEYS.get(sort, 'created_at')
+    key = getattr(Idea, key_name)
+    limit = max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+
+    search = _search_subquery(q) if q else None
+    if search is not None:
+        fields = _list_fields(fields, *(['id'] if include_comments else []))
+        query = _idea_list_query(fields, status, category, city_id, user_id, bbox)
+        return _search_page(search, fields, query, after, before, limit, include_comments)
+
+    # Ключ сортировки и id нужны для построения курсоров
+    cursor_field = IDEA_CURSOR_FIELDS[key_name]
+    fields = _list_fields(fields, 'id', cursor_field)
+    query = _idea_list_query(fields, status, category, city_id, user_id, bbox)
+
+    after_pos = decode_cursor(after, sort)
+    before_pos = decode_cursor(before, sort) if not after_pos else None
+
+    # Порядок всегда (ключ DESC, id DESC); страница "назад" читается
+    # в обратном порядке и разворачивается
+    if before_pos:
+        query = query.filter(tuple_(key, Idea.id) > tuple_(*before_pos)) \
+                     .order_by(key.asc(), Idea.id.asc())
+    else:
+        if after_pos:
+            query = query.filter(tuple_(key, Idea.id) < tuple_(*after_pos))
+        query = query.order_by(key.desc(), Idea.id.desc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_pos:
+        rows.reverse()
+
+    key_idx, id_idx = fields.index(cursor_field), fields.index('id')
+    first = encode_cursor(rows[0][key_idx], rows[0][id_idx]) if rows else None
+    last = encode_cursor(rows[-1][key_idx], rows[-1][id_idx]) if rows else None
+    if before_pos:
+        next_cursor, prev_cursor = last, first if has_more else None
+    else:
+        next_cursor, prev_cursor = last if has_more else None, first if after_pos else None
+
+    ideas = _rows_to_records(fields, rows, include_comments)
+    return {'ideas': ideas, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
+
+EXPORT_BATCH_SIZE = 1000
+
+def iter_ideas(status=None, category=None, city_id=None, user_id=None,
+               sort='new', after=None, fields=None, bbox=None, q=None,
+               batch_size=EXPORT_BATCH_SIZE):
+    """Все идеи выборки по одной, в порядке get_ideas_page, без ограничения
+    по числу.
+
+    Строки читаются из курсора пачками по batch_size (yield_per), поэтому
+    память не растёт с размером результата. after - курсор страницы, с
+    которого продолжить. Генератор должен исчерпываться внутри app context.
+    """
+    key_name = IDEA_SORT_KEYS.get(sort, 'created_at')
+    key = getattr(Idea, key_name)
+    fields = _list_fields(fields)
+    query = _idea_list_query(fields, status, category, city_id, user_id, bbox)
+
+    search = _search_subquery(q) if q else None
+    if search is not None:
+        query = query.join(search, search.c.rowid == Idea.id) \
+                     .order_by(search.c.rank, Idea.votes_count.desc(), Idea.id.desc())
+        if after:
+            query = query.offset(_decode_offset_cursor(after))
+    else:
+        after_pos = decode_cursor(after, sort)
+        if after_pos:
+            query = query.filter(tuple_(key, Idea.id) < tuple_(*after_pos))
+        query = query.order_by(key.desc(), Idea.id.desc())
+
+    make = record_type(tuple(fields))._make
+    for row in query.yield_per(batch_size):
+        yield make(row)
+
+def get_idea_points(status=None, category=None, city_id=None, bbox=None):
+    """Только то, что нужно маркеру: (id, широта, долгота, категория, голоса)"""
+    query = db.session.query(Idea.id, Idea.latitude, Idea.longitude, Idea.category, Idea.votes_count)
+    return _filter_ideas(query, status, category, city_id, bbox=bbox).all()
+
+def get_idea_summary(idea_id, fields=None):
+    """Строка списка идей для одной идеи (без комментариев и счётчика просмотров)"""
+    fields = _list_fields(fields)
+    return record(fields, _idea_list_query(fields).filter(Idea.id == idea_id).first())
 
 def get_idea_by_id(idea_id, increment_views=True):
-    idea = Idea.query.get(idea_id)
-    if not idea:
+    """Идея со всеми полями списка и комментариями (с их авторами) - двумя запросами"""
+    row = _idea_list_query(IDEA_LIST_FIELDS).filter(Idea.id == idea_id).first()
+    if not row:
         return None
+    idea = _rows_to_records(IDEA_LIST_FIELDS, [row], include_comments=True)[0]
     if increment_views:
-        idea.views_count += 1
-        db.session.commit()
-    return idea_to_dict(idea, include_comments=True)
+        # Просмотр не пишется в базу сразу, а копится в буфере (см. ViewBuffer)
+        view_buffer.add(idea_id, db.engine)
+    return idea._replace(views_count=(idea.views_count or 0) + view_buffer.pending(idea_id))
 
 def get_ideas_by_user(user_id):
-    ideas = Idea.query.filter_by(user_id=user_id).order_by(Idea.created_at.desc()).all()
-    return [idea_to_dict(i, include_comments=True) for i in ideas]
+    return get_all_ideas(user_id=user_id)
 
 def update_idea_status(idea_id, status):
-    idea = Idea.query.get(idea_id)
-    if idea:
-        idea.status = status
-        db.session.commit()
+    update_ideas_status([idea_id], status)
+
+def update_ideas_status(idea_ids, status):
+    """Переводит идеи в статус status одной транзакцией (модерация пачкой).
+
+    Идеи читаются одним запросом, статус меняется одним UPDATE ... IN,
+    сетка кластеров, счётчики и версии обновляются агрегированно по всей
+    пачке. Возвращает {id: 'updated' | 'unchanged' | 'not_found'}."""
+    idea_ids = list(dict.fromkeys(idea_ids))
+    results = dict.fromkeys(idea_ids, 'not_found')
+    if not idea_ids:
+        return results
+    rows = db.session.query(Idea.id, Idea.status, Idea.category, Idea.city_id,
+                            Idea.latitude, Idea.longitude) \
+                     .filter(Idea.id.in_(idea_ids)).all()
+    changed = []
+    cells = {}
+    counters = []
+    names = set()
+    for idea_id, old_status, category, city_id, latitude, longitude in rows:
+        if old_status == status:
+            results[idea_id] = 'unchanged'
+            continue
+        results[idea_id] = 'updated'
+        changed.append(idea_id)
+        _add_to_map_cells(cells, latitude, longitude, old_status, category, city_id, -1)
+        _add_to_map_cells(cells, latitude, longitude, status, category, city_id, 1)
+        counters += _status_counters(old_status, category, -1) + _status_counters(status, category, 1)
+        names.update(idea_version_names(old_status, city_id), idea_version_names(status, city_id))
+    if not changed:
+        return results
+
+    db.session.execute(update(Idea).where(Idea.id.in_(changed)).values(status=status)
+                       .execution_options(synchronize_session=False))
+    _upsert(MapCell, list(_map_cell_rows(cells)), ('count', 'sum_lat', 'sum_lng'))
+    _delete_empty_map_cells([key for key, cell in cells.items() if cell[0] < 0])
+    _bump_counters(counters)
+    bump_data_versions(*names)
+    db.session.commit()
+    return results
+
+def clear_image_path(image_path):
+    """Убирает ссылку на изображение, варианты которого не удалось создать,
+    у всех идей с этим ключом. Возвращает число таких идей."""
+    ideas = db.session.query(Idea.id, Idea.status, Idea.city_id).filter(Idea.image_path == image_path).all()
+    if not ideas:
+        return 0
+    Idea.query.filter(Idea.image_path == image_path).update({'image_path': None}, synchronize_session=False)
+    bump_data_versions(*(name for _, status, city_id in ideas for name in idea_version_names(status, city_id)))
+    db.session.commit()
+    return len(ideas)
 
 def delete_idea(idea_id):
     idea = Idea.query.get(idea_id)
     if not idea:
         return True
-    if idea.image_path:
-        image_path = os.path.join('static/uploads', idea.image_path)
-        if os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-            except:
-                pass
-    Comment.query.filter_by(idea_id=idea_id).delete()
-    Vote.query.filter_by(idea_id=idea_id).delete()
+    image_path = idea.image_path
+    comments_deleted = Comment.query.filter_by(idea_id=idea_id).delete()
+    votes_deleted = Vote.query.filter_by(idea_id=idea_id).delete()
+    _unindex_idea_text(idea_id)
+    _shift_map_cells(idea.latitude, idea.longitude, idea.status, idea.category, idea.city_id, -1)
+    _bump_counters(_idea_counters(idea.status, idea.category, idea.city_id, idea.user_id,
+                                  idea.created_at, -1) +
+                   [('comments', '', -comments_deleted), ('votes', '', -votes_deleted)])
+    bump_data_versions(*idea_version_names(idea.status, idea.city_id))
     db.session.delete(idea)
     db.session.commit()
+    # Файлы удаляются только после успешного коммита. Файлы изображений общие
+    # для одинаковых загрузок - удаляем, только если на них больше никто не ссылается
+    if image_path and not Idea.query.filter(Idea.image_path == image_path).first():
+        images.delete_image(image_path, 'static/uploads')
     return True
 
 def get_popular_ideas(limit=5):
@@ -245,30 +1083,111 @@ def get_popular_ideas(limit=5):
 def get_latest_ideas(limit=5):
     return get_all_ideas(status='approved', limit=limit)
 
+# ------------------------------------------------------------
+# Буфер просмотров
+# ------------------------------------------------------------
+class ViewBuffer:
+    """Отложенная запись счётчиков просмотров.
+
+    Просмотры копятся в памяти процесса и записываются одним executemany
+    UPDATE раз в flush_interval секунд или когда накопится max_pending
+    просмотров, а также при завершении процесса. При аварийном падении
+    теряется не больше max_pending просмотров (и не больше, чем набралось
+    за flush_interval секунд).
+    """
+
+    def __init__(self, flush_interval=5.0, max_pending=1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._counts = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._engine = None
+        self._pid = None
+
+    def add(self, idea_id, engine):
+        with self._lock:
+            self._counts[idea_id] = self._counts.get(idea_id, 0) + 1
+            self._total += 1
+            full = self._total >= self.max_pending
+            # Поток запускается лениво и заново после fork: потоки не наследуются
+            if self._pid != os.getpid():
+                self._start(engine)
+        if full:
+            self._wakeup.set()
+
+    def pending(self, idea_id):
+        with self._lock:
+            return self._counts.get(idea_id, 0)
+
+    def _start(self, engine):
+        self._engine = engine
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='view-buffer', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts, self._total = self._counts, {}, 0
+            engine = self._engine
+        if not counts or engine is None:
+            return 0
+
+        stmt = update(Idea.__table__) \
+            .where(Idea.__table__.c.id == bindparam('idea_id')) \
+            .values(views_count=func.coalesce(Idea.__table__.c.views_count, 0) + bindparam('views'))
+        try:
+            with engine.begin() as conn:
+                conn.execute(stmt, [{'idea_id': idea_id, 'views': n} for idea_id, n in counts.items()])
+        except Exception:
+            logging.getLogger(__name__).exception('Не удалось записать просмотры, повтор позже')
+            with self._lock:
+                for idea_id, n in counts.items():
+                    self._counts[idea_id] = self._counts.get(idea_id, 0) + n
+                    self._total += n
+            return 0
+        return sum(counts.values())
+
+view_buffer = ViewBuffer()
+atexit.register(view_buffer.flush)
+
+def flush_views():
+    return view_buffer.flush()
+
 # ------------------------------------------------------------
 # Голоса
 # ------------------------------------------------------------
 def add_vote(user_id, idea_id):
-    existing = Vote.query.filter_by(user_id=user_id, idea_id=idea_id).first()
-    if existing:
+    """Голос без предварительной проверки: повторный голос отсекает
+    уникальный индекс (user_id, idea_id), а счётчик увеличивается в базе,
+    поэтому параллельные запросы не дают ни дублей, ни потерянных голосов."""
+    stmt = _dialect_insert(Vote).values(user_id=user_id, idea_id=idea_id) \
+                                .on_conflict_do_nothing(index_elements=['user_id', 'idea_id'])
+    if db.session.execute(stmt).rowcount == 0:
+        db.session.rollback()
         return False
-    vote = Vote(user_id=user_id, idea_id=idea_id)
-    db.session.add(vote)
-    idea = Idea.query.get(idea_id)
+    idea = db.session.execute(update(Idea).where(Idea.id == idea_id)
+                                          .values(votes_count=func.coalesce(Idea.votes_count, 0) + 1)
+                                          .returning(Idea.status, Idea.city_id)).first()
+    _bump_counters([('votes', '', 1)])
     if idea:
-        idea.votes_count += 1
+        bump_data_versions(*idea_version_names(idea.status, idea.city_id))
     db.session.commit()
     return True
 
 def get_votes_by_idea(idea_id):
-    votes = Vote.query.filter_by(idea_id=idea_id).all()
-    return [{'id': v.id, 'user_id': v.user_id, 'idea_id': v.idea_id,
-             'created_at': v.created_at.strftime('%Y-%m-%d %H:%M:%S') if v.created_at else None}
-            for v in votes]
+    rows = db.session.query(Vote.id, Vote.user_id, Vote.idea_id, timestamp_text(Vote.created_at)) \
+                     .filter(Vote.idea_id == idea_id).all()
+    return records(('id', 'user_id', 'idea_id', 'created_at'), rows)
 
 def get_user_votes(user_id):
-    votes = Vote.query.filter_by(user_id=user_id).all()
-    return [v.idea_id for v in votes]
+    return db.session.scalars(select(Vote.idea_id).where(Vote.user_id == user_id)).all()
 
 # ------------------------------------------------------------
 # Комментарии
@@ -276,54 +1195,154 @@ def get_user_votes(user_id):
 def add_comment(text, user_id, idea_id):
     comment = Comment(text=text, user_id=user_id, idea_id=idea_id)
     db.session.add(comment)
+    _bump_counters([('comments', '', 1)])
     db.session.commit()
     return comment.id
 
 def get_comments_by_idea(idea_id):
-    comments = Comment.query.filter_by(idea_id=idea_id).order_by(Comment.created_at).all()
-    return [comment_to_dict(c) for c in comments]
+    return _comments_by_idea([idea_id])[idea_id]
 
 # ------------------------------------------------------------
 # Статистика
 # ------------------------------------------------------------
+# Общие показатели не считаются запросами COUNT по всем таблицам, а хранятся
+# в stat_counter и обновляются в той же транзакции, что и изменение данных.
+# rebuild_stats() пересчитывает их с нуля (python setup.py --rebuild-stats).
+def _day_key(created_at):
+    return (created_at or datetime.utcnow()).strftime('%Y-%m-%d')
+
+def _status_counters(status, category, delta):
+    counters = [('ideas_by_status', status or '', delta)]
+    if status == 'approved':
+        counters.append(('approved_by_category', category, delta))
+    return counters
+
+def _idea_counters(status, category, city_id, user_id, created_at, delta):
+    return [('ideas', '', delta),
+            ('ideas_by_city', str(city_id or ''), delta),
+            ('ideas_by_user', str(user_id), delta),
+            ('ideas_by_day', _day_key(created_at), delta)] + \
+           _status_counters(status, category, delta)
+
+def _bump_counters(counters):
+    """Прибавляет delta к счётчикам [(name, key, delta), ...] одним запросом.
+    Не коммитит: вызывается внутри транзакции изменения данных."""
+    merged = {}
+    for name, key, delta in counters:
+        merged[(name, key)] = merged.get((name, key), 0) + delta
+    rows = [dict(name=name, key=key, value=delta)
+            for (name, key), delta in merged.items() if delta]
+    if rows:
+        _upsert(StatCounter, rows, ('value',))
+
+def rebuild_stats():
+    """Пересчитывает все счётчики статистики по текущим данным"""
+    counters = [
+        ('ideas', '', Idea.query.count()),
+        ('users', '', User.query.count()),
+        ('votes', '', Vote.query.count()),
+        ('comments', '', Comment.query.count()),
+        ('active_cities', '', City.query.filter_by(is_active=True).count()),
+    ]
+    for status, cnt in db.session.query(Idea.status, func.count(Idea.id)).group_by(Idea.status):
+        counters.append(('ideas_by_status', status or '', cnt))
+    for category, cnt in db.session.query(Idea.category, func.count(Idea.id)) \
+                                   .filter(Idea.status == 'approved').group_by(Idea.category):
+        counters.append(('approved_by_category', category, cnt))
+    for city_id, cnt in db.session.query(Idea.city_id, func.count(Idea.id)).group_by(Idea.city_id):
+        counters.append(('ideas_by_city', str(city_id or ''), cnt))
+    for user_id, cnt in db.session.query(Idea.user_id, func.count(Idea.id)).group_by(Idea.user_id):
+        counters.append(('ideas_by_user', str(user_id), cnt))
+    day = func.strftime('%Y-%m-%d', Idea.created_at) if db.engine.dialect.name == 'sqlite' \
+        else func.to_char(Idea.created_at, 'YYYY-MM-DD')
+    for day_key, cnt in db.session.query(day, func.count(Idea.id)).group_by(day):
+        if day_key:
+            counters.append(('ideas_by_day', day_key, cnt))
+
+    StatCounter.query.delete()
+    db.session.add_all(StatCounter(name=name, key=key, value=value) for name, key, value in counters)
+    db.session.commit()
+    return len(counters)
+
 def get_stats():
     stats = {}
-    stats['total_ideas'] = Idea.query.count()
-    stats['approved_ideas'] = Idea.query.filter_by(status='approved').count()
-    stats['pending_ideas'] = Idea.query.filter_by(status='pending').count()
-    stats['implemented_ideas'] = Idea.query.filter_by(status='implemented').count()
-    stats['total_users'] = User.query.count()
-    stats['total_votes'] = Vote.query.count()
-    stats['total_comments'] = Comment.query.count()
-    stats['total_cities'] = City.query.filter_by(is_active=True).count()
-
-    categories = db.session.query(Idea.category, func.count(Idea.id).label('count')) \
-                           .filter(Idea.status == 'approved') \
-                           .group_by(Idea.category).all()
-    stats['categories'] = [{'category': cat, 'count': cnt} for cat, cnt in categories]
-
-    cities_stats = db.session.query(City.name, func.count(Idea.id).label('count')) \
-                              .outerjoin(Idea, City.id == Idea.city_id) \
-                              .group_by(City.id).all()
-    stats['cities_stats'] = [{'name': name, 'count': cnt} for name, cnt in cities_stats]
 
+    totals = {}
+    # Идеи за последние 7x24 часа: полные дни после граничного - из счётчиков,
+    # остаток граничного дня - запросом по индексу (status, created_at)
     week_ago = datetime.utcnow() - timedelta(days=7)
-    stats['recent_ideas'] = Idea.query.filter(Idea.created_at >= week_ago).count()
+    edge_day_end = datetime(week_ago.year, week_ago.month, week_ago.day) + timedelta(days=1)
+    rows = db.session.query(StatCounter.name, StatCounter.key, StatCounter.value) \
+                     .filter(or_(StatCounter.name.in_(['ideas', 'users', 'votes', 'comments', 'active_cities',
+                                                          'ideas_by_status', 'approved_by_category']),
+                                    and_(StatCounter.name == 'ideas_by_day',
+                                         StatCounter.key >= _day_key(edge_day_end)))) \
+                     .all()
+    categories = []
+    recent = 0
+    for name, key, value in rows:
+        if name == 'approved_by_category':
+            if value:
+                categories.append({'category': key, 'count': value})
+        elif name == 'ideas_by_day':
+            recent += value
+        else:
+            totals[(name, key)] = value
 
-    active = db.session.query(User.username, func.count(Idea.id).label('ideas_count')) \
-                        .outerjoin(Idea, User.id == Idea.user_id) \
-                        .group_by(User.id) \
-                        .order_by(func.count(Idea.id).desc()) \
-                        .limit(10).all()
-    stats['active_users'] = [{'username': u, 'ideas_count': cnt} for u, cnt in active]
+    stats['total_ideas'] = totals.get(('ideas', ''), 0)
+    stats['approved_ideas'] = totals.get(('ideas_by_status', 'approved'), 0)
+    stats['pending_ideas'] = totals.get(('ideas_by_status', 'pending'), 0)
+    stats['implemented_ideas'] = totals.get(('ideas_by_status', 'implemented'), 0)
+    stats['total_users'] = totals.get(('users', ''), 0)
+    stats['total_votes'] = totals.get(('votes', ''), 0)
+    stats['total_comments'] = totals.get(('comments', ''), 0)
+    stats['total_cities'] = totals.get(('active_cities', ''), 0)
+    stats['categories'] = categories
+    stats['recent_ideas'] = recent + Idea.query.filter(Idea.status.in_(IDEA_STATUSES),
+                                                       Idea.created_at >= week_ago,
+                                                       Idea.created_at < edge_day_end).count()
 
-    top = Idea.query.filter_by(status='approved') \
-                    .order_by(Idea.votes_count.desc()) \
-                    .limit(10).all()
-    stats['top_ideas'] = [idea_to_dict(idea, include_comments=False) for idea in top]
+    city_count = db.session.query(StatCounter.value) \
+                           .filter(StatCounter.name == 'ideas_by_city',
+                                   StatCounter.key == func.cast(City.id, db.String)) \
+                           .correlate(City).scalar_subquery()
+    cities_stats = db.session.query(City.name, func.coalesce(city_count, 0)).order_by(City.id).all()
+    stats['cities_stats'] = [{'name': name, 'count': cnt} for name, cnt in cities_stats]
+
+    active = db.session.query(StatCounter.key, StatCounter.value) \
+                       .filter(StatCounter.name == 'ideas_by_user', StatCounter.value > 0) \
+                       .order_by(StatCounter.value.desc()) \
+                       .limit(10).all()
+    usernames = dict(db.session.query(User.id, User.username)
+                               .filter(User.id.in_([int(key) for key, _ in active])).all())
+    stats['active_users'] = [{'username': usernames.get(int(key)), 'ideas_count': cnt}
+                             for key, cnt in active if int(key) in usernames]
+    # Как и раньше, список дополняется пользователями без идей
+    if len(stats['active_users']) < 10:
+        idle = db.session.query(User.username).filter(User.id.notin_(list(usernames))) \
+                         .order_by(User.id).limit(10 - len(stats['active_users'])).all()
+        stats['active_users'] += [{'username': username, 'ideas_count': 0} for username, in idle]
+
+    stats['top_ideas'] = get_all_ideas(status='approved', limit=10, order_by='votes_count DESC')
 
     return stats
 
+def get_admin_counts():
+    """Показатели админки одним запросом к stat_counter по первичному ключу:
+    итоги и число идей по статусам, без подсчёта строк идей"""
+    rows = db.session.query(StatCounter.name, StatCounter.key, StatCounter.value) \
+                     .filter(StatCounter.name.in_(['ideas', 'users', 'votes', 'active_cities',
+                                                   'ideas_by_status'])) \
+                     .all()
+    totals = {(name, key): value for name, key, value in rows}
+    return {
+        'total_ideas': totals.get(('ideas', ''), 0),
+        'total_users': totals.get(('users', ''), 0),
+        'total_votes': totals.get(('votes', ''), 0),
+        'total_cities': totals.get(('active_cities', ''), 0),
+        'ideas_by_status': {status: totals.get(('ideas_by_status', status), 0) for status in IDEA_STATUSES},
+    }
+
 def get_user_stats(user_id):
     stats = {}
     stats['ideas_count'] = Idea.query.filter_by(user_id=user_id).count()
@@ -0,0 +1,213 @@
+"""
+Генератор синтетических данных для нагрузочных замеров.
+
+    python generate_data.py --ideas 100000 --seed 42 --database sqlite:////tmp/bench.db
+
+Создаёт пользователей, города, идеи (координаты скоплениями вокруг центров
+городов), голоса и комментарии. При одинаковых параметрах и seed данные
+получаются одинаковыми, поэтому замеры разных коммитов сравнимы. Строки
+вставляются пачками мимо create_idea/add_vote, а производные данные
+(полнотекстовый индекс, сетка кластеров, счётчики статистики) затем
+пересчитываются целиком.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+CATEGORIES = ['спорт', 'культура', 'детский досуг', 'экология', 'транспорт', 'благоустройство',
+              'образование', 'здравоохранение']
+STATUSES = [('approved', 60), ('pending', 20), ('implemented', 10), ('rejected', 10)]
+# Города Кузбасса: (название, широта, долгота); при большем числе городов
+# добавляются «Посёлок N» в окрестностях
+CITY_CENTERS = [
+    ('Кисилевск', 54.0000, 86.5833), ('Кемерово', 55.3544, 86.0878),
+    ('Новокузнецк', 53.7557, 87.1094), ('Прокопьевск', 53.8954, 86.7446),
+    ('Ленинск-Кузнецкий', 54.6567, 86.1737), ('Междуреченск', 53.6865, 88.0700),
+    ('Белово', 54.4165, 86.2976), ('Юрга', 55.7136, 84.9339),
+    ('Анжеро-Судженск', 56.0786, 86.0201), ('Берёзовский', 55.6693, 86.2743),
+]
+WORDS = ['парк', 'сквер', 'велосипедная', 'дорожка', 'детская', 'площадка', 'остановка', 'освещение',
+         'скамейки', 'фонтан', 'каток', 'библиотека', 'спортивная', 'школа', 'поликлиника', 'аллея',
+         'деревья', 'клумба', 'парковка', 'тротуар', 'пешеходный', 'переход', 'мусорные', 'контейнеры',
+         'набережная', 'стадион', 'бассейн', 'концерт', 'фестиваль', 'выставка', 'автобус', 'маршрут',
+         'ремонт', 'двор', 'новый', 'удобный', 'безопасный', 'зелёный', 'городской', 'летний']
+# Все даты отсчитываются от фиксированного момента, а не от текущего времени
+BASE_DATE = datetime(2025, 1, 1)
+PERIOD_DAYS = 365
+BATCH_SIZE = 10000
+SCALE_SUFFIXES = {'k': 1000, 'M': 1000000}
+
+
+def parse_scale(value):
+    """'100k' / '1M' / '2500' -> число идей"""
+    value = str(value)
+    if value[-1:] in SCALE_SUFFIXES:
+        return int(float(value[:-1]) * SCALE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def _text(rng, min_words, max_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))).capitalize()
+
+
+def _weighted(rng, choices):
+    values = [v for v, _ in choices]
+    weights = [w for _, w in choices]
+    return rng.choices(values, weights)[0]
+
+
+class _BatchInserter:
+    """Копит строки и вставляет их пачками по BATCH_SIZE одним executemany.
+    after - вставщик строк, на которые ссылаются эти (сбрасывается раньше)"""
+
+    def __init__(self, table, after=None):
+        self.table = table
+        self.after = after
+        self.rows = []
+        self.total = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        from sqlalchemy import insert
+        from models import db
+
+        if self.after:
+            self.after.flush()
+        if self.rows:
+            db.session.execute(insert(self.table), self.rows)
+            self.total += len(self.rows)
+            self.rows = []
+
+
+def generate(ideas, users=None, cities=10, votes_per_idea=5.0, comments_per_idea=2.0, seed=42,
+             log=print):
+    """Добавляет синтетические данные в текущую базу (нужен app context).
+    Возвращает словарь с числом созданных строк."""
+    from sqlalchemy import func, text
+    from werkzeug.security import generate_password_hash
+    import database
+    from models import db, User, City, Idea, Vote, Comment
+
+    rng = random.Random(seed)
+    users = users or max(10, ideas // 10)
+    started = time.perf_counter()
+
+    if db.engine.dialect.name == 'sqlite':
+        # Генерацию можно повторить, поэтому надёжность записи не нужна
+        db.session.execute(text('PRAGMA synchronous = OFF'))
+
+    # Один хэш на всех: хэширование пароля намеренно медленное
+    password_hash = generate_password_hash('password')
+    first_user = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+    batch = _BatchInserter(User.__table__)
+    for i in range(users):
+        user_id = first_user + i
+        batch.add({'id': user_id, 'username': f'user{user_id}', 'email': f'user{user_id}@example.com',
+                   'password_hash': password_hash, 'is_admin': False,
+                   'created_at': BASE_DATE + timedelta(seconds=rng.randrange(PERIOD_DAYS * 86400))})
+    batch.flush()
+    user_ids = range(first_user, first_user + users)
+    log(f'✓ Пользователи: {users}')
+
+    first_city = (db.session.query(func.max(City.id)).scalar() or 0) + 1
+    centers = []
+    batch = _BatchInserter(City.__table__)
+    for i in range(cities):
+        if i < len(CITY_CENTERS):
+            name, lat, lng = CITY_CENTERS[i]
+        else:
+            base = CITY_CENTERS[i % len(CITY_CENTERS)]
+            name, lat, lng = f'Посёлок {i}', base[1] + rng.uniform(-1, 1), base[2] + rng.uniform(-1, 1)
+        batch.add({'id': first_city + i, 'name': name, 'description': f'Синтетический город {name}',
+                   'latitude': lat, 'longitude': lng, 'zoom': 12, 'is_active': True, 'created_at': BASE_DATE})
+        # Крупные города получают больше идей
+        centers.append((first_city + i, lat, lng, 1.0 / (i + 1)))
+    batch.flush()
+    log(f'✓ Города: {cities}')
+
+    city_weights = [c[3] for c in centers]
+    first_idea = (db.session.query(func.max(Idea.id)).scalar() or 0) + 1
+    idea_batch = _BatchInserter(Idea.__table__)
+    vote_batch = _BatchInserter(Vote.__table__, after=idea_batch)
+    comment_batch = _BatchInserter(Comment.__table__, after=idea_batch)
+    for i in range(ideas):
+        idea_id = first_idea + i
+        city_id, lat, lng, _ = rng.choices(centers, city_weights)[0]
+        # Несколько «районов» вокруг центра, внутри района - нормальный разброс
+        district = rng.randrange(8)
+        lat += 0.03 * (district % 3 - 1) + rng.gauss(0, 0.01)
+        lng += 0.05 * (district // 3 - 1) + rng.gauss(0, 0.015)
+        status = _weighted(rng, STATUSES)
+        created_at = BASE_DATE + timedelta(seconds=rng.randrange(PERIOD_DAYS * 86400))
+
+        voters = []
+        if status in ('approved', 'implemented'):
+            # Экспоненциальное распределение: большинство идей с парой голосов, немногие - популярные
+            count = min(users, int(rng.expovariate(1.0 / votes_per_idea)))
+            voters = rng.sample(user_ids, count)
+        for user_id in voters:
+            vote_batch.add({'user_id': user_id, 'idea_id': idea_id,
+                            'created_at': created_at + timedelta(minutes=rng.randrange(60 * 24 * 30))})
+        for _ in range(int(rng.expovariate(1.0 / comments_per_idea)) if comments_per_idea else 0):
+            comment_batch.add({'text': _text(rng, 3, 15), 'user_id': rng.choice(user_ids), 'idea_id': idea_id,
+                               'created_at': created_at + timedelta(minutes=rng.randrange(60 * 24 * 30))})
+
+        idea_batch.add({'id': idea_id, 'title': _text(rng, 2, 6), 'description': _text(rng, 10, 40),
+                        'category': rng.choice(CATEGORIES), 'latitude': lat, 'longitude': lng,
+                        'user_id': rng.choice(user_ids), 'city_id': city_id, 'status': status,
+                        'votes_count': len(voters), 'views_count': rng.randrange(1000),
+                        'created_at': created_at, 'image_path': None})
+        if (i + 1) % 100000 == 0:
+            log(f'  ... идей: {i + 1}')
+    vote_batch.flush()
+    comment_batch.flush()
+    db.session.commit()
+    log(f'✓ Идеи: {idea_batch.total}, голоса: {vote_batch.total}, комментарии: {comment_batch.total}')
+
+    database.rebuild_search_index()
+    database.rebuild_map_cells()
+    database.rebuild_stats()
+    names = ['cities']
+    for status, _ in STATUSES:
+        names += [name for city_id, *_ in centers for name in database.idea_version_names(status, city_id)]
+    database.bump_data_versions(*names)
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text('ANALYZE'))
+    db.session.commit()
+    log(f'✓ Индексы и счётчики пересчитаны ({time.perf_counter() - started:.1f} с)')
+
+    return {'users': users, 'cities': cities, 'ideas': idea_batch.total,
+            'votes': vote_batch.total, 'comments': comment_batch.total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Генерация синтетических данных "Города Идей"')
+    parser.add_argument('--ideas', default='1k', help='Число идей: число или 1k/10k/100k/1M')
+    parser.add_argument('--users', type=int, help='Число пользователей (по умолчанию идей / 10)')
+    parser.add_argument('--cities', type=int, default=10, help='Число городов')
+    parser.add_argument('--votes-per-idea', type=float, default=5.0, help='Среднее число голосов за идею')
+    parser.add_argument('--comments-per-idea', type=float, default=2.0,
+                        help='Среднее число комментариев к идее')
+    parser.add_argument('--seed', type=int, default=42, help='Начальное значение генератора')
+    parser.add_argument('--database', help='URL базы данных (по умолчанию DATABASE_URL)')
+    args = parser.parse_args()
+
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+
+    from app import app
+    with app.app_context():
+        generate(parse_scale(args.ideas), users=args.users, cities=args.cities,
+                 votes_per_idea=args.votes_per_idea, comments_per_idea=args.comments_per_idea,
+                 seed=args.seed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
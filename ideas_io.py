@@ -0,0 +1,461 @@
+"""
+Импорт и выгрузка идей в CSV и GeoJSON.
+
+    python ideas_io.py import ideas.geojson --user admin --status approved
+    python ideas_io.py import ideas.csv --city Кемерово --dry-run
+    python ideas_io.py export ideas.csv --status approved
+    python ideas_io.py export - --format geojsonl > ideas.geojsonl
+
+Файл читается потоком, целиком в памяти не держится: CSV - построчно,
+GeoJSON FeatureCollection - по одному объекту из массива features,
+GeoJSON построчно (.geojsonl, .ndjson, RFC 8142) - по строке. Каждая строка
+проверяется; ошибочные пропускаются и выводятся с номером строки (объекта).
+Город берётся по названию из city_name или city (без учёта регистра),
+и только если названия нет - по city_id: id городов в другой базе могут
+не совпадать. Иначе город из --city, иначе ближайший не дальше
+--max-city-distance км. Автор - username строки или --user.
+
+Идеи вставляются пачками по --batch-size через database.create_ideas:
+одна транзакция на пачку вместе с индексом поиска, сеткой кластеров и
+счётчиками. Голоса и просмотры не импортируются.
+
+Выгрузка читает идеи курсором (database.iter_ideas) и пишет их по одной:
+память не зависит от числа идей. Выгруженный CSV/GeoJSON можно снова
+импортировать.
+"""
+import os
+import re
+import sys
+import csv
+import json
+import math
+import time
+import argparse
+from datetime import datetime
+
+BATCH_SIZE = 5000
+PROGRESS_EVERY = 10000
+MAX_REPORTED_ERRORS = 50
+MAX_CITY_DISTANCE_KM = 50.0
+CHUNK_SIZE = 1 << 16
+FORMATS = {'.csv': 'csv', '.geojson': 'geojson', '.json': 'geojson',
+           '.geojsonl': 'geojsonl', '.geojsons': 'geojsonl', '.ndjson': 'geojsonl', '.jsonl': 'geojsonl'}
+# Поля выгрузки; created_at и city_name при импорте читаются обратно
+EXPORT_FIELDS = ('id', 'title', 'description', 'category', 'status', 'latitude', 'longitude',
+                 'city_id', 'city_name', 'username', 'votes_count', 'views_count', 'created_at',
+                 'image_path')
+
+
+def log(message):
+    # Выгрузка может идти в stdout, поэтому сообщения - в stderr
+    print(message, file=sys.stderr)
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+    if not fmt:
+        raise ValueError(f'Не удалось определить формат {path}, укажите --format')
+    return fmt
+
+
+# ------------------------------------------------------------
+# Чтение
+# ------------------------------------------------------------
+_NON_SPACE = re.compile(r'\S')
+
+
+class _JSONStream:
+    """Чтение JSON-документа по частям: значения разбираются из буфера,
+    который дочитывается из потока по CHUNK_SIZE символов"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+
+    def _fill(self):
+        chunk = self.stream.read(CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Следующий непробельный символ ('' в конце потока)"""
+        while True:
+            match = _NON_SPACE.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'GeoJSON: ожидалось {char!r}, получено {found or "конец файла"!r}')
+        self.pos += 1
+
+    def skip(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if self._fill():
+                    continue
+                raise ValueError(f'GeoJSON: {e}') from None
+            # Число в конце буфера могло быть обрезано
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_feature_collection(stream):
+    """Объекты features из FeatureCollection; прочие ключи пропускаются"""
+    reader = _JSONStream(stream)
+    reader.expect('{')
+    if reader.skip('}'):
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'features':
+            reader.expect('[')
+            if not reader.skip(']'):
+                while True:
+                    yield reader.value()
+                    if not reader.skip(','):
+                        reader.expect(']')
+                        break
+        else:
+            reader.value()
+        if not reader.skip(','):
+            reader.expect('}')
+            return
+
+
+def _iter_feature_lines(stream):
+    for line_number, line in enumerate(stream, 1):
+        # RFC 8142: каждая запись начинается с символа RS
+        line = line.strip().lstrip('\x1e')
+        if line:
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, ValueError(f'некорректный JSON: {e}')
+
+
+def _feature_row(feature):
+    if not isinstance(feature, dict) or feature.get('type') != 'Feature':
+        raise ValueError('ожидался объект Feature')
+    row = dict(feature.get('properties') or {})
+    geometry = feature.get('geometry') or {}
+    if geometry.get('type') != 'Point':
+        raise ValueError('геометрия должна быть Point')
+    coordinates = geometry.get('coordinates') or []
+    if len(coordinates) < 2:
+        raise ValueError('у точки нет координат')
+    row['longitude'], row['latitude'] = coordinates[0], coordinates[1]
+    return row
+
+
+def read_rows(stream, fmt):
+    """(номер строки или объекта, словарь полей либо ValueError) по одному"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'geojsonl':
+        for number, feature in _iter_feature_lines(stream):
+            if isinstance(feature, ValueError):
+                yield number, feature
+                continue
+            try:
+                yield number, _feature_row(feature)
+            except ValueError as e:
+                yield number, e
+    else:
+        for number, feature in enumerate(_iter_feature_collection(stream), 1):
+            try:
+                yield number, _feature_row(feature)
+            except ValueError as e:
+                yield number, e
+
+
+# ------------------------------------------------------------
+# Проверка строк
+# ------------------------------------------------------------
+def _text(row, *names):
+    for name in names:
+        value = row.get(name)
+        if value is not None and str(value).strip():
+            return str(value).strip()
+    return None
+
+
+def _number(row, *names):
+    value = _text(row, *names)
+    if value is None:
+        raise ValueError(f'нет поля {names[0]}')
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f'{names[0]}: не число: {value!r}') from None
+    if not math.isfinite(number):
+        raise ValueError(f'{names[0]}: не число: {value!r}')
+    return number
+
+
+def _city_key(name):
+    return name.strip().lower().replace('ё', 'е')
+
+
+def _distance_km(lat1, lng1, lat2, lng2):
+    # Равнопромежуточная проекция: для выбора ближайшего города точности хватает
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371.0 * math.hypot(x, y)
+
+
+class RowValidator:
+    """Превращает строку файла в словарь для database.create_ideas"""
+
+    def __init__(self, user, city=None, status='pending', max_city_distance=MAX_CITY_DISTANCE_KM):
+        import database
+
+        self.database = database
+        self.cities = database.get_all_cities(active_only=False)
+        self.cities_by_id = {c.id: c for c in self.cities}
+        self.cities_by_name = {_city_key(c.name): c for c in self.cities}
+        self.max_city_distance = max_city_distance
+        self.users = {}
+        self.default_user = self.user_id(user)
+        if self.default_user is None:
+            raise ValueError(f'Пользователь {user} не найден')
+        self.default_city = None
+        if city:
+            self.default_city = self.find_city(city)
+            if self.default_city is None:
+                raise ValueError(f'Город {city} не найден')
+        if status not in database.IDEA_STATUSES:
+            raise ValueError(f'Неизвестный статус {status}')
+        self.default_status = status
+
+    def user_id(self, username):
+        if username not in self.users:
+            user = self.database.get_user_by_username(username)
+            self.users[username] = user.id if user else None
+        return self.users[username]
+
+    def find_city(self, value):
+        value = str(value).strip()
+        if value.isdigit() and int(value) in self.cities_by_id:
+            return self.cities_by_id[int(value)]
+        return self.cities_by_name.get(_city_key(value))
+
+    def nearest_city(self, latitude, longitude):
+        best, best_distance = None, self.max_city_distance
+        for city in self.cities:
+            distance = _distance_km(latitude, longitude, city.latitude, city.longitude)
+            if distance <= best_distance:
+                best, best_distance = city, distance
+        return best
+
+    def validate(self, row):
+        title = _text(row, 'title')
+        if not title:
+            raise ValueError('нет названия (title)')
+        if len(title) > 200:
+            raise ValueError('название длиннее 200 символов')
+        description = _text(row, 'description')
+        if not description:
+            raise ValueError('нет описания (description)')
+        category = _text(row, 'category')
+        if not category:
+            raise ValueError('нет категории (category)')
+        if len(category) > 50:
+            raise ValueError('категория длиннее 50 символов')
+
+        latitude = _number(row, 'latitude', 'lat')
+        longitude = _number(row, 'longitude', 'lng', 'lon')
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError(f'координаты вне диапазона: {latitude}, {longitude}')
+
+        status = _text(row, 'status') or self.default_status
+        if status not in self.database.IDEA_STATUSES:
+            raise ValueError(f'неизвестный статус {status!r}')
+
+        # Название важнее id: выгрузка другой базы несёт её id городов
+        city = None
+        city_name = _text(row, 'city_name', 'city')
+        city_id = _text(row, 'city_id')
+        if city_name:
+            city = self.find_city(city_name)
+            if city is None:
+                raise ValueError(f'город {city_name!r} не найден')
+        elif city_id:
+            city = self.cities_by_id.get(int(city_id)) if city_id.isdigit() else None
+            if city is None:
+                raise ValueError(f'город с id {city_id!r} не найден')
+        city = city or self.default_city or self.nearest_city(latitude, longitude)
+
+        username = _text(row, 'username')
+        user_id = self.user_id(username) if username else self.default_user
+        if user_id is None:
+            raise ValueError(f'пользователь {username!r} не найден')
+
+        created_at = _text(row, 'created_at')
+        if created_at:
+            try:
+                created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00')).replace(tzinfo=None)
+            except ValueError:
+                raise ValueError(f'некорректная дата {created_at!r}') from None
+
+        return {'title': title, 'description': description, 'category': category,
+                'latitude': latitude, 'longitude': longitude, 'status': status,
+                'city_id': city.id if city else None, 'user_id': user_id, 'created_at': created_at}
+
+
+# ------------------------------------------------------------
+# Импорт и выгрузка
+# ------------------------------------------------------------
+def import_ideas(stream, fmt, validator, batch_size=BATCH_SIZE, dry_run=False):
+    """Проверяет и вставляет идеи из потока (нужен app context).
+    Возвращает словарь с числом вставленных и ошибочных строк."""
+    import database
+
+    label = 'строка' if fmt in ('csv', 'geojsonl') else 'объект'
+    started = time.perf_counter()
+    imported = errors = 0
+    batch = []
+
+    def flush():
+        nonlocal imported
+        if not dry_run:
+            database.create_ideas(batch)
+        imported += len(batch)
+        batch.clear()
+        elapsed = time.perf_counter() - started
+        log(f'  ... идей: {imported} ({imported / elapsed:.0f}/с)')
+
+    for number, row in read_rows(stream, fmt):
+        try:
+            if isinstance(row, ValueError):
+                raise row
+            batch.append(validator.validate(row))
+        except ValueError as e:
+            errors += 1
+            if errors <= MAX_REPORTED_ERRORS:
+                log(f'✗ {label} {number}: {e}')
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    if errors > MAX_REPORTED_ERRORS:
+        log(f'  ... и ещё ошибок: {errors - MAX_REPORTED_ERRORS}')
+    return {'imported': imported, 'errors': errors}
+
+
+def _feature(idea):
+    properties = {f: idea[f] for f in EXPORT_FIELDS if f not in ('latitude', 'longitude')}
+    return {'type': 'Feature', 'id': idea.id,
+            'geometry': {'type': 'Point', 'coordinates': [idea.longitude, idea.latitude]},
+            'properties': properties}
+
+
+def export_ideas(out, fmt, status=None, category=None, city_id=None):
+    """Пишет идеи в поток по одной (нужен app context). Возвращает их число."""
+    import database
+
+    ideas = database.iter_ideas(status=status, category=category, city_id=city_id, fields=EXPORT_FIELDS)
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(EXPORT_FIELDS)
+    elif fmt == 'geojson':
+        out.write('{"type": "FeatureCollection", "features": [\n')
+    for idea in ideas:
+        if fmt == 'csv':
+            writer.writerow(idea)
+        elif fmt == 'geojsonl':
+            out.write(json.dumps(_feature(idea), ensure_ascii=False) + '\n')
+        else:
+            out.write((',\n' if count else '') + json.dumps(_feature(idea), ensure_ascii=False))
+        count += 1
+        if count % PROGRESS_EVERY == 0:
+            log(f'  ... идей: {count}')
+    if fmt == 'geojson':
+        out.write('\n]}\n')
+    return count
+
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    # utf-8-sig: CSV из Excel начинается с BOM; newline='' - требование модуля csv
+    return open(path, mode, encoding='utf-8-sig' if mode == 'r' else 'utf-8', newline='')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Импорт и выгрузка идей "Города Идей"')
+    parser.add_argument('--database', help='URL базы данных (по умолчанию DATABASE_URL)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('import', help='Загрузить идеи из CSV или GeoJSON')
+    load.add_argument('path', help='Файл ("-" - stdin, тогда нужен --format)')
+    load.add_argument('--format', choices=sorted(set(FORMATS.values())), help='Формат (по расширению файла)')
+    load.add_argument('--user', default='admin', help='Автор идей, у которых нет username')
+    load.add_argument('--city', help='Город (id или название) для идей без города')
+    load.add_argument('--status', default='pending', help='Статус идей, у которых он не указан')
+    load.add_argument('--max-city-distance', type=float, default=MAX_CITY_DISTANCE_KM,
+                      help='Искать ближайший город не дальше, км')
+    load.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Идей в одной транзакции')
+    load.add_argument('--dry-run', action='store_true', help='Только проверить файл, ничего не записывая')
+
+    dump = commands.add_parser('export', help='Выгрузить идеи в CSV или GeoJSON')
+    dump.add_argument('path', help='Файл ("-" - stdout, тогда нужен --format)')
+    dump.add_argument('--format', choices=sorted(set(FORMATS.values())), help='Формат (по расширению файла)')
+    dump.add_argument('--status', help='Только идеи с этим статусом')
+    dump.add_argument('--category', help='Только идеи этой категории')
+    dump.add_argument('--city-id', type=int, help='Только идеи этого города')
+    args = parser.parse_args()
+
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+
+    from app import app
+    with app.app_context():
+        try:
+            fmt = detect_format(args.path, args.format)
+            if args.command == 'import':
+                validator = RowValidator(args.user, args.city, args.status, args.max_city_distance)
+                with _open(args.path, 'r') as stream:
+                    result = import_ideas(stream, fmt, validator, args.batch_size, args.dry_run)
+                verb = 'Проверено' if args.dry_run else 'Импортировано'
+                log(f"✓ {verb} идей: {result['imported']}, ошибок: {result['errors']}")
+                return 1 if result['errors'] else 0
+            with _open(args.path, 'w') as out:
+                count = export_ideas(out, fmt, args.status, args.category, args.city_id)
+            log(f'✓ Выгружено идей: {count}')
+        except ValueError as e:
+            log(f'❌ {e}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+Обработка загруженных фотографий идей.
+
+Файл из формы не сохраняется как есть: по содержимому проверяется, что это
+действительно картинка (расширению не верим), а на диск пишутся только
+пересжатые варианты без EXIF и прочих метаданных (там бывают координаты
+съёмки):
+
+    <upload_folder>/ab/<sha256>-400.webp     миниатюра для списков
+    <upload_folder>/ab/<sha256>-400.jpg
+    <upload_folder>/ab/<sha256>-1280.webp    средний размер для страницы идеи
+    <upload_folder>/ab/<sha256>-1280.jpg
+
+Имя - sha256 исходных байтов, поэтому одинаковые загрузки хранятся один раз,
+а в Idea.image_path записывается только этот ключ. Пережатие идёт в фоновом
+пуле потоков: проверка формата читает лишь заголовок, и POST не ждёт
+кодирования.
+"""
+import os
+import re
+import atexit
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+# Вариант -> максимальная сторона в пикселях; пропорции сохраняются
+VARIANT_SIZES = {'thumb': 400, 'medium': 1280}
+VARIANT_FORMATS = (('webp', 'WEBP', {'quality': 80, 'method': 4}),
+                   ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}))
+# Защита от «бомб»: картинка 10 КБ на диске может разворачиваться в гигабайты
+Image.MAX_IMAGE_PIXELS = 40_000_000
+
+_KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ImageError(ValueError):
+    """Загруженный файл не является поддерживаемым изображением"""
+
+
+def is_image_key(image_path):
+    """True для путей, созданных этим модулем (старые загрузки - обычные имена файлов)"""
+    return bool(image_path and _KEY_RE.match(image_path))
+
+
+def variant_path(key, name, ext):
+    """Путь варианта относительно папки загрузок"""
+    return f'{key[:2]}/{key}-{VARIANT_SIZES[name]}.{ext}'
+
+
+def variant_paths(key):
+    return [variant_path(key, name, ext) for name in VARIANT_SIZES for ext, _, _ in VARIANT_FORMATS]
+
+
+def read_upload(file_storage):
+    """Читает загрузку и проверяет по содержимому, что это изображение.
+
+    Возвращает байты файла; при неподходящем содержимом - ImageError.
+    """
+    data = file_storage.read()
+    if not data:
+        raise ImageError('Файл пуст')
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if image.format not in ALLOWED_FORMATS:
+                raise ImageError('Поддерживаются изображения JPEG, PNG, GIF и WebP')
+            image.verify()
+    except ImageError:
+        raise
+    except Image.DecompressionBombError:
+        raise ImageError('Слишком большое изображение')
+    except Exception:
+        raise ImageError('Файл не является изображением')
+    return data
+
+
+class ImageProcessor:
+    """Фоновое создание вариантов изображений.
+
+    Пул создаётся лениво и заново после fork (как у ViewBuffer), одинаковые
+    загрузки, пришедшие одновременно, обрабатываются один раз.
+
+    Ключ возвращается до обработки, поэтому об ошибке кодирования узнаёт
+    только on_failure(key) - его вызывают в потоке пула, чтобы приложение
+    убрало ключ у идей. Ключ мог ещё не попасть в базу: такие ключи
+    запоминаются, их проверяют через failed(key) после записи идеи.
+    """
+
+    def __init__(self, max_workers=2, on_failure=None):
+        self.max_workers = max_workers
+        self.on_failure = on_failure
+        # RLock: колбэк уже завершённой задачи вызывается сразу, под этой же блокировкой
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._failed = set()
+        self._executor = None
+        self._pid = None
+
+    def save(self, data, upload_folder):
+        """Ставит изображение в обработку и сразу возвращает его ключ"""
+        key = hashlib.sha256(data).hexdigest()
+        if all(os.path.exists(os.path.join(upload_folder, path)) for path in variant_paths(key)):
+            return key
+
+        with self._lock:
+            if key not in self._pending:
+                self._failed.discard(key)
+                future = self._get_executor().submit(self._process, data, key, upload_folder)
+                self._pending[key] = future
+                future.add_done_callback(lambda f: self._done(key))
+        return key
+
+    def wait(self, timeout=None):
+        """Дожидается обработки всех поставленных изображений"""
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.exception(timeout)
+
+    def failed(self, key):
+        """True, если последняя обработка key в этом процессе закончилась ошибкой"""
+        with self._lock:
+            return key in self._failed
+
+    def _done(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            self._pending = {}
+            self._failed = set()
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='images')
+        return self._executor
+
+    def _process(self, data, key, upload_folder):
+        try:
+            with Image.open(BytesIO(data)) as source:
+                source.seek(0)  # у GIF берём первый кадр
+                # Поворот из EXIF применяем до того, как метаданные будут отброшены
+                image = ImageOps.exif_transpose(source)
+                has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+
+            os.makedirs(os.path.join(upload_folder, key[:2]), exist_ok=True)
+            for name, size in VARIANT_SIZES.items():
+                variant = image.copy()
+                variant.thumbnail((size, size), Image.LANCZOS)
+                for ext, fmt, options in VARIANT_FORMATS:
+                    out = variant
+                    if fmt == 'JPEG' and out.mode == 'RGBA':
+                        out = Image.new('RGB', variant.size, (255, 255, 255))
+                        out.paste(variant, mask=variant.getchannel('A'))
+                    path = os.path.join(upload_folder, variant_path(key, name, ext))
+                    # Пишем во временный файл и переименовываем, чтобы не отдать
+                    # наполовину записанную картинку
+                    tmp_path = f'{path}.{os.getpid()}.tmp'
+                    out.save(tmp_path, fmt, **options)
+                    os.replace(tmp_path, path)
+        except Exception:
+            logger.exception('Не удалось обработать изображение %s', key)
+            with self._lock:
+                self._failed.add(key)
+            if self.on_failure:
+                try:
+                    self.on_failure(key)
+                except Exception:
+                    logger.exception('Не удалось убрать ссылки на изображение %s', key)
+
+
+processor = ImageProcessor()
+atexit.register(processor.wait)
+
+
+def delete_image(image_path, upload_folder):
+    """Удаляет файлы изображения (все варианты или старый одиночный файл)"""
+    paths = variant_paths(image_path) if is_image_key(image_path) else [image_path]
+    for path in paths:
+        try:
+            os.remove(os.path.join(upload_folder, path))
+        except OSError:
+            pass
+
+
+def image_urls(image_path, url_for):
+    """URL'ы для <picture>: src, srcset в JPEG и srcset в WebP (None для старых загрузок)"""
+    def url(path):
+        return url_for('static', filename='uploads/' + path)
+
+    if not is_image_key(image_path):
+        return {'src': url(image_path), 'thumb': url(image_path), 'srcset': None, 'webp_srcset': None}
+
+    def srcset(ext):
+        return ', '.join(f'{url(variant_path(image_path, name, ext))} {size}w'
+                         for name, size in VARIANT_SIZES.items())
+
+    return {
+        'src': url(variant_path(image_path, 'medium', 'jpg')),
+        'thumb': url(variant_path(image_path, 'thumb', 'jpg')),
+        'srcset': srcset('jpg'),
+        'webp_srcset': srcset('webp')
+    }
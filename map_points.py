@@ -0,0 +1,59 @@
+"""
+Компактный бинарный формат точек для слоя карты.
+
+Вместо JSON-объекта на каждую идею ответ содержит колонки одинаковой длины
+(все числа little-endian), поэтому клиент разбирает их типизированными
+массивами без парсинга JSON:
+
+    0   4 байта   сигнатура b'GIP1'
+    4   uint32    N - число точек
+    8   uint32    L - длина таблицы категорий
+    12  L байт    JSON-список названий категорий (UTF-8), дополнен пробелами
+                  до кратного 4
+        float32[N] широты
+        float32[N] долготы
+        uint32[N]  id идей
+        uint32[N]  число голосов
+        uint8[N]   индекс категории в таблице категорий
+
+Точность float32 для координат - порядка метра, для маркера этого достаточно.
+"""
+import json
+import sys
+from array import array
+
+MAGIC = b'GIP1'
+MIME_TYPE = 'application/vnd.gorod-idey.points'
+
+
+def _column(typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def encode_points(rows):
+    """rows - последовательность (id, latitude, longitude, category, votes_count)"""
+    ids, lats, lngs, votes, category_idx = [], [], [], [], []
+    categories = {}
+    for idea_id, latitude, longitude, category, votes_count in rows:
+        ids.append(idea_id)
+        lats.append(latitude)
+        lngs.append(longitude)
+        votes.append(votes_count or 0)
+        category_idx.append(categories.setdefault(category, len(categories)))
+
+    table = json.dumps(list(categories), ensure_ascii=False).encode('utf-8')
+    table += b' ' * (-len(table) % 4)
+
+    return b''.join([
+        MAGIC,
+        _column('I', [len(ids), len(table)]),
+        table,
+        _column('f', lats),
+        _column('f', lngs),
+        _column('I', ids),
+        _column('I', votes),
+        _column('B', category_idx),
+    ])
@@ -0,0 +1,153 @@
+"""
+Метрики обработки запросов в текстовом формате Prometheus.
+
+Для каждого endpoint'а Flask собираются гистограммы времени ответа, числа
+SQL-запросов, времени в SQL и размера ответа, а также счётчик ответов по
+кодам. SQL считается событиями SQLAlchemy на всех движках. Метрики хранятся
+в памяти процесса: при нескольких worker'ах каждый отдаёт свои, а сервер
+метрик суммирует их по меткам.
+
+С app.config['METRICS_DEBUG_HEADERS'] в каждый ответ добавляются
+X-Query-Count и Server-Timing (видны во вкладке Network браузера).
+"""
+import time
+import threading
+from bisect import bisect_left
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PREFIX = 'gorod_'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками; значения - по верхним границам корзин"""
+
+    def __init__(self, name, help, buckets, labels):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self.series = {}
+
+    def observe(self, label_values, value):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total, count) in sorted(self.series.items()):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, label_values, value=1):
+        self.series[label_values] = self.series.get(label_values, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self.series.items()):
+            lines.append(f'{self.name}{{{_labels(self.labels, label_values)}}} {value}')
+        return lines
+
+
+def _labels(names, values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+_lock = threading.Lock()
+requests_total = Counter(PREFIX + 'http_requests_total', 'Обработанные запросы',
+                         ('endpoint', 'method', 'status'))
+request_duration = Histogram(PREFIX + 'http_request_duration_seconds', 'Время обработки запроса',
+                             LATENCY_BUCKETS, ('endpoint', 'method'))
+request_queries = Histogram(PREFIX + 'http_request_sql_queries', 'Число SQL-запросов за запрос',
+                            QUERY_BUCKETS, ('endpoint',))
+request_sql_time = Histogram(PREFIX + 'http_request_sql_seconds', 'Время в SQL за запрос',
+                             LATENCY_BUCKETS, ('endpoint',))
+response_size = Histogram(PREFIX + 'http_response_size_bytes', 'Размер тела ответа',
+                          SIZE_BUCKETS, ('endpoint',))
+METRICS = (requests_total, request_duration, request_queries, request_sql_time, response_size)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info['metrics_query_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_start', None)
+    if started is not None and has_request_context() and 'metrics_start' in g:
+        g.metrics_sql_time += time.perf_counter() - started
+        g.metrics_queries += 1
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_sql_time = 0.0
+
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+    duration = time.perf_counter() - g.metrics_start
+    endpoint = request.endpoint or 'unmatched'
+    size = response.content_length
+    with _lock:
+        requests_total.inc((endpoint, request.method, response.status_code))
+        request_duration.observe((endpoint, request.method), duration)
+        request_queries.observe((endpoint,), g.metrics_queries)
+        request_sql_time.observe((endpoint,), g.metrics_sql_time)
+        if size is not None:
+            response_size.observe((endpoint,), size)
+
+    if current_app.config['METRICS_DEBUG_HEADERS']:
+        response.headers['X-Query-Count'] = str(g.metrics_queries)
+        response.headers['Server-Timing'] = (
+            f'db;dur={g.metrics_sql_time * 1000:.1f};desc="{g.metrics_queries} SQL", '
+            f'app;dur={duration * 1000:.1f}')
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('METRICS_DEBUG_HEADERS', False)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus"""
+    with _lock:
+        lines = []
+        for metric in METRICS:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
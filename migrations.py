@@ -0,0 +1,169 @@
+"""
+Версионные миграции схемы.
+
+db.create_all() создаёт недостающие таблицы, но не трогает существующие,
+поэтому всё, что меняется в уже созданных таблицах (индексы, колонки,
+исправление данных), оформляется миграцией:
+
+    @migration(4, 'описание')
+    def _add_something():
+        ...
+
+Номера идут по возрастанию и не переиспользуются. upgrade() вызывается из
+init_db при каждом старте и применяет те, которых ещё нет в schema_migration.
+Миграции пишутся идемпотентными: на новой базе create_all уже создал всё по
+моделям, и миграция лишь отмечается применённой.
+"""
+import re
+import logging
+import sqlite3
+from sqlalchemy import func, select, update, inspect, text, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from models import db, Idea, Vote, Comment, DataVersion, SchemaMigration
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def decorator(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def applied_versions():
+    return set(db.session.scalars(select(SchemaMigration.version)))
+
+
+def upgrade():
+    """Применяет недостающие миграции; возвращает список применённых (version, name)"""
+    applied = applied_versions()
+    done = []
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info('Миграция %s: %s', version, name)
+        func()
+        db.session.add(SchemaMigration(version=version, name=name))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Ту же миграцию одновременно применил другой процесс
+            db.session.rollback()
+            continue
+        done.append((version, name))
+    return done
+
+
+def _create_indexes(model):
+    for index in model.__table__.indexes:
+        db.session.execute(CreateIndex(index, if_not_exists=True))
+
+
+@migration(1, 'уникальный индекс голосов')
+def _vote_unique_index():
+    # Дубли, если они успели появиться до индекса, удаляются,
+    # а votes_count пересчитывается
+    if inspect(db.engine).has_index('vote', 'uq_vote_user_idea'):
+        return
+    keep = select(func.min(Vote.id)).group_by(Vote.user_id, Vote.idea_id)
+    if Vote.query.filter(Vote.id.not_in(keep)).delete(synchronize_session=False):
+        votes = select(func.count(Vote.id)).where(Vote.idea_id == Idea.id).scalar_subquery()
+        db.session.execute(update(Idea).values(votes_count=votes))
+    _create_indexes(Vote)
+
+
+@migration(2, 'время изменения версий данных')
+def _data_version_updated_at():
+    columns = {c['name'] for c in inspect(db.engine).get_columns('data_version')}
+    if 'updated_at' not in columns:
+        db.session.execute(text('ALTER TABLE data_version ADD COLUMN updated_at DATETIME'))
+
+
+@migration(3, 'составные индексы идей, голосов и комментариев')
+def _query_indexes():
+    for model in (Idea, Vote, Comment):
+        _create_indexes(model)
+    if db.engine.dialect.name == 'sqlite':
+        # Статистика по индексам помогает планировщику выбрать нужный
+        db.session.execute(text('ANALYZE'))
+
+
+# ------------------------------------------------------------
+# Проверка планов запросов
+# ------------------------------------------------------------
+# Полный проход по таблице без индекса; "SCAN idea USING INDEX ..." -
+# обход индекса в нужном порядке - допустим
+FULL_SCAN_RE = re.compile(r'^SCAN (TABLE )?(idea|vote|comment)\b(?!.*\bUSING\b)')
+
+
+def _representative_queries():
+    """Вызовы модуля database, повторяющие запросы страниц и API"""
+    import database
+    return [
+        lambda: database.get_ideas_page(status='approved'),
+        lambda: database.get_ideas_page(status='approved', sort='popular'),
+        lambda: database.get_ideas_page(status='approved', city_id=1),
+        lambda: database.get_ideas_page(status='approved', city_id=1, sort='popular'),
+        lambda: database.get_ideas_page(status='approved', category='спорт'),
+        lambda: database.get_ideas_page(status='implemented', include_comments=True),
+        lambda: database.get_all_ideas(user_id=1),
+        lambda: database.get_latest_ideas(limit=3),
+        lambda: database.get_popular_ideas(limit=3),
+        lambda: database.get_comments_by_idea(1),
+        lambda: database.get_votes_by_idea(1),
+        lambda: database.get_user_votes(1),
+        lambda: database.get_user_stats(1),
+    ]
+
+
+def _schema_copy():
+    """Пустая база в памяти с той же схемой, но без статистики ANALYZE:
+    на маленькой базе планировщик честно выбрал бы полный проход, а проверить
+    нужно наличие индексов, а не размер данных"""
+    copy = sqlite3.connect(':memory:')
+    with db.engine.connect() as conn:
+        schema = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type IN ('table', 'index') "
+            "AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY type = 'index'").scalars().all()
+    for ddl in schema:
+        try:
+            copy.execute(ddl)
+        except sqlite3.OperationalError:
+            pass  # служебные таблицы R*Tree/FTS5 создаются вместе с виртуальными
+    return copy
+
+
+def check_query_plans():
+    """Выполняет типовые запросы и возвращает [(sql, строка плана)] для тех,
+    что читают idea/vote/comment полным проходом. Только для SQLite."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    # На всех движках: чтения идут через отдельный пул (см. storage.py)
+    event.listen(Engine, 'before_cursor_execute', capture)
+    try:
+        for query in _representative_queries():
+            query()
+    finally:
+        event.remove(Engine, 'before_cursor_execute', capture)
+
+    problems = []
+    copy = _schema_copy()
+    try:
+        for statement, parameters in statements:
+            for row in copy.execute('EXPLAIN QUERY PLAN ' + statement, parameters):
+                if FULL_SCAN_RE.match(row[-1]):
+                    problems.append((statement, row[-1]))
+    finally:
+        copy.close()
+    return problems
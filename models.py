@@ -2,8 +2,10 @@ from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from storage import RoutingSession
 
-db = SQLAlchemy()
+# Сессия сама выбирает пул соединений: для чтения или для записи (см. storage.py)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -51,6 +53,18 @@ class Idea(db.Model):
     # ЕДИНСТВЕННАЯ связь с городом, обратная к City.ideas
     city = db.relationship('City', back_populates='ideas', lazy=True)
 
+    # Индексы под фильтры и сортировки списков идей (новые/популярные, по городу,
+    # категории и автору); id в конце ключа SQLite добавляет сам
+    __table_args__ = (
+        db.Index('ix_idea_status_created', 'status', 'created_at'),
+        db.Index('ix_idea_status_city_created', 'status', 'city_id', 'created_at'),
+        db.Index('ix_idea_status_category_created', 'status', 'category', 'created_at'),
+        db.Index('ix_idea_status_votes', 'status', 'votes_count'),
+        db.Index('ix_idea_status_city_votes', 'status', 'city_id', 'votes_count'),
+        db.Index('ix_idea_user_created', 'user_id', 'created_at'),
+        db.Index('ix_idea_image_path', 'image_path'),
+    )
+
 class Vote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -59,6 +73,13 @@ class Vote(db.Model):
     
     user = db.relationship('User', backref=db.backref('votes', lazy=True))
     idea = db.relationship('Idea', backref=db.backref('vote_details', lazy=True))
+    
+    # Один голос пользователя за идею гарантирует база, а не проверка в коде
+    # (user_id, idea_id) заодно служит для выборок голосов пользователя
+    __table_args__ = (
+        db.Index('uq_vote_user_idea', 'user_id', 'idea_id', unique=True),
+        db.Index('ix_vote_idea', 'idea_id'),
+    )
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -69,3 +90,47 @@ class Comment(db.Model):
     
     user = db.relationship('User', backref=db.backref('comments', lazy=True))
     idea = db.relationship('Idea', backref=db.backref('comments', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_comment_idea_created', 'idea_id', 'created_at'),
+        db.Index('ix_comment_user', 'user_id'),
+    )
+
+class MapCell(db.Model):
+    """Ячейка сетки кластеров карты: сколько идей данного статуса и категории
+    попало в ячейку (level, cell_x, cell_y) и сумма их координат для центроида"""
+    __tablename__ = 'map_cell'
+    level = db.Column(db.Integer, primary_key=True)
+    cell_x = db.Column(db.Integer, primary_key=True)
+    cell_y = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    category = db.Column(db.String(50), primary_key=True)
+    city_id = db.Column(db.Integer, primary_key=True, default=0)  # 0 - без города
+    count = db.Column(db.Integer, nullable=False, default=0)
+    sum_lat = db.Column(db.Float, nullable=False, default=0.0)
+    sum_lng = db.Column(db.Float, nullable=False, default=0.0)
+
+class StatCounter(db.Model):
+    """Счётчик для статистики: name - что считаем, key - разрез
+    (статус, категория, id города/автора, день), пустая строка - без разреза"""
+    __tablename__ = 'stat_counter'
+    name = db.Column(db.String(50), primary_key=True)
+    key = db.Column(db.String(100), primary_key=True, default='')
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ix_stat_counter_name_value', 'name', 'value'),)
+
+class DataVersion(db.Model):
+    """Номер версии набора данных (например, справочника городов).
+    Увеличивается при каждом изменении; по нему процессы сверяют свои кэши."""
+    __tablename__ = 'data_version'
+    name = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchemaMigration(db.Model):
+    """Применённая миграция схемы (см. migrations.py)"""
+    __tablename__ = 'schema_migration'
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,138 @@
+"""
+Обнаружение N+1 запросов для разработки и проверочных прогонов.
+
+Во время запроса (или внутри `with nplusone.detect():`) запоминаются все
+SELECT'ы. Запросы с одинаковым текстом SQL, различающиеся только
+параметрами, считаются одной группой; когда группа повторяется больше K
+раз, выдаётся предупреждение (или исключение) с местом вызова в
+database.py - обычно это ленивая загрузка связи в цикле вроде
+`comment.user.username` при обходе ORM-объектов.
+
+Включается переменной окружения NPLUSONE=warn|raise (app.config['NPLUSONE']),
+порог - NPLUSONE_THRESHOLD (по умолчанию 5). Выключенный детектор не
+подписывается на события и ничего не стоит.
+"""
+import os
+import re
+import sys
+import logging
+import warnings
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 5
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Места вызова ищутся сначала в слое данных, потом в остальном коде проекта
+PREFERRED_FILES = ('database.py',)
+IGNORED_FILES = (os.path.abspath(__file__),)
+
+_IN_LIST_RE = re.compile(r'\((?:\?|%\(\w+\)s|__\[POSTCOMPILE_\w+\])(?:, *(?:\?|%\(\w+\)s))*\)')
+
+_tracker = ContextVar('nplusone_tracker', default=None)
+
+
+class NPlusOneWarning(UserWarning):
+    pass
+
+
+class NPlusOneError(Exception):
+    pass
+
+
+class _Tracker:
+    def __init__(self, threshold, mode, label):
+        self.threshold = threshold
+        self.mode = mode
+        self.label = label
+        self.groups = {}
+        self.lazy_load = None
+        self.reported = []
+
+    def record(self, statement):
+        key = _IN_LIST_RE.sub('(?)', statement)
+        count = self.groups.get(key, 0) + 1
+        self.groups[key] = count
+        lazy_load, self.lazy_load = self.lazy_load, None
+        if count == self.threshold + 1:
+            self.report(key, lazy_load)
+
+    def report(self, statement, lazy_load):
+        site = call_site()
+        what = f'ленивая загрузка {lazy_load}' if lazy_load else 'одинаковый запрос'
+        message = (f'N+1 в {self.label}: {what} выполняется больше {self.threshold} раз, '
+                   f'вызов из {site}\n  {" ".join(statement.split())}')
+        self.reported.append(message)
+        if self.mode == 'raise':
+            raise NPlusOneError(message)
+        warnings.warn(message, NPlusOneWarning, stacklevel=2)
+        logger.warning(message)
+
+
+def call_site():
+    """Ближайший к запросу кадр стека в database.py, иначе - в коде проекта"""
+    frame = sys._getframe(1)
+    fallback = None
+    while frame:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(PROJECT_DIR) and filename not in IGNORED_FILES:
+            site = f'{os.path.relpath(filename, PROJECT_DIR)}:{frame.f_lineno} ({frame.f_code.co_name})'
+            if os.path.basename(filename) in PREFERRED_FILES:
+                return site
+            fallback = fallback or site
+        frame = frame.f_back
+    return fallback or 'неизвестно'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracker = _tracker.get()
+    if tracker is not None and not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+        tracker.record(statement)
+
+
+def _do_orm_execute(orm_execute_state):
+    tracker = _tracker.get()
+    if tracker is not None and orm_execute_state.is_relationship_load:
+        path = orm_execute_state.loader_strategy_path
+        tracker.lazy_load = str(path[-1]) if path else 'связи'
+
+
+def _listen():
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Session, 'do_orm_execute', _do_orm_execute)
+
+
+@contextmanager
+def detect(threshold=DEFAULT_THRESHOLD, mode='raise', label='блоке'):
+    """Проверяет запросы внутри блока; возвращает трекер со списком находок (.reported)"""
+    _listen()
+    tracker = _Tracker(threshold, mode, label)
+    token = _tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _tracker.reset(token)
+
+
+def init_app(app):
+    app.config.setdefault('NPLUSONE', os.environ.get('NPLUSONE', ''))
+    app.config.setdefault('NPLUSONE_THRESHOLD', int(os.environ.get('NPLUSONE_THRESHOLD', DEFAULT_THRESHOLD)))
+    if app.config['NPLUSONE'] not in ('warn', 'raise'):
+        return
+    _listen()
+
+    @app.before_request
+    def _start_tracking():
+        _tracker.set(_Tracker(app.config['NPLUSONE_THRESHOLD'], app.config['NPLUSONE'],
+                              f'{request.method} {request.path}'))
+
+    @app.teardown_request
+    def _stop_tracking(exc):
+        _tracker.set(None)
@@ -0,0 +1,143 @@
+"""
+Хэширование и проверка паролей вне потока запроса.
+
+Хэш пароля намеренно дорогой: десятки миллисекунд процессора на вызов.
+Если считать его прямо в обработчике, волна входов занимает все потоки
+worker'а, и обычные страницы ждут. Поэтому хэш считается в отдельном пуле
+процессов (PASSWORD_POOL_SIZE процессов), а число задач в пуле и в очереди
+ограничено PASSWORD_QUEUE_LIMIT: сверх него сразу выбрасывается
+PasswordHasherBusy, и приложение отвечает 503 вместо того, чтобы копить
+очередь. PASSWORD_POOL_SIZE=0 - считать в потоке запроса, как раньше.
+
+Стоимость задаётся PASSWORD_HASH_METHOD в формате werkzeug
+('pbkdf2:sha256:600000', 'scrypt:32768:8:1'). Хэши со старыми
+параметрами пересчитываются при следующем успешном входе (needs_rehash).
+"""
+import os
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_METHOD = 'pbkdf2:sha256:600000'
+DEFAULT_POOL_SIZE = 2
+RESULT_TIMEOUT = 30
+
+
+# Число частей полной записи метода: 'pbkdf2:sha256:600000', 'scrypt:32768:8:1'
+METHOD_PARTS = {'pbkdf2': 3, 'scrypt': 4}
+
+
+def expand_method(method):
+    """Метод в том виде, в каком werkzeug записывает его в хэш ('scrypt' ->
+    'scrypt:32768:8:1'). Для неполной записи параметры по умолчанию берутся
+    у самого werkzeug - одним хэшем пустой строки."""
+    if len(method.split(':')) == METHOD_PARTS.get(method.split(':', 1)[0]):
+        return method
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+class PasswordHasherBusy(RuntimeError):
+    """В пуле хэширования нет места: запрос нужно отклонить"""
+
+
+class PasswordHasher:
+    """Пул процессов для хэширования паролей с ограничением очереди.
+
+    Пул создаётся лениво и заново после fork (как у ImageProcessor):
+    процессы и потоки пула родителя дочернему процессу не достаются.
+    Процессы пула fork'аются, только пока в процессе нет других потоков
+    (start() в post_fork worker'а); из многопоточного процесса fork копирует
+    блокировки, захваченные чужими потоками, поэтому там пул создаётся
+    через forkserver.
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, pool_size=DEFAULT_POOL_SIZE, queue_limit=None):
+        self.configure(method, pool_size, queue_limit)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def configure(self, method, pool_size, queue_limit=None):
+        # Полная запись, иначе needs_rehash никогда не совпадёт с хэшем
+        self.method = expand_method(method)
+        self.pool_size = pool_size
+        # По умолчанию - по четыре задачи на процесс пула
+        self.queue_limit = queue_limit if queue_limit is not None else pool_size * 4
+        self._slots = threading.BoundedSemaphore(max(self.queue_limit, 1))
+
+    def hash(self, password):
+        return self._call(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._call(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True, если хэш посчитан не с текущими параметрами"""
+        return pwhash.split('$', 1)[0] != self.method
+
+    def start(self):
+        """Создаёт пул и сразу запускает его процессы"""
+        if self.pool_size:
+            self._get_executor().submit(int).result(RESULT_TIMEOUT)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _call(self, fn, *args):
+        if not self.pool_size:
+            return fn(*args)
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise PasswordHasherBusy('Слишком много одновременных входов')
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        return future.result(RESULT_TIMEOUT)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                # fork: процессу пула не нужно заново импортировать приложение;
+                # с fork все процессы пула запускаются сразу при первой задаче
+                methods = multiprocessing.get_all_start_methods()
+                if 'fork' in methods and threading.active_count() == 1:
+                    context = multiprocessing.get_context('fork')
+                else:
+                    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._executor = ProcessPoolExecutor(self.pool_size, mp_context=context)
+            return self._executor
+
+
+hasher = PasswordHasher()
+atexit.register(hasher.shutdown)
+
+
+def init_app(app):
+    app.config.setdefault('PASSWORD_HASH_METHOD', os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD))
+    app.config.setdefault('PASSWORD_POOL_SIZE', int(os.environ.get('PASSWORD_POOL_SIZE', DEFAULT_POOL_SIZE)))
+    queue_limit = os.environ.get('PASSWORD_QUEUE_LIMIT')
+    app.config.setdefault('PASSWORD_QUEUE_LIMIT', int(queue_limit) if queue_limit else None)
+    hasher.configure(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_POOL_SIZE'],
+                     app.config['PASSWORD_QUEUE_LIMIT'])
+
+
+def hash_password(password):
+    return hasher.hash(password)
+
+
+def verify_password(pwhash, password):
+    return hasher.verify(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return hasher.needs_rehash(pwhash)
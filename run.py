@@ -1,25 +1,114 @@
 #!/usr/bin/env python3
 """
 Простой скрипт для запуска приложения
+
+    python run.py                                   # сервер разработки
+    python run.py --workers 4 --threads 2 --bind 0.0.0.0:8000
+
+С --workers приложение запускается в рабочем режиме под gunicorn: оно
+импортируется один раз в главном процессе, после чего worker'ы создаются
+fork'ом. Worker перезапускается после --max-requests запросов (со случайным
+разбросом, чтобы не все сразу), так что рост памяти ограничен.
+
+Сигналы главному процессу:
+    HUP        - плавно заменить worker'ов; код приложения при этом не
+                 перечитывается (он загружен до fork), для обновления кода
+                 нужен перезапуск главного процесса или USR2
+    TERM, INT  - дождаться текущих запросов (до --graceful-timeout) и
+                 завершиться; каждый worker перед выходом записывает
+                 накопленные просмотры
 """
 
 import os
 import sys
+import argparse
 
 # Добавляем текущую директорию в путь
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app import app
 
-if __name__ == '__main__':
+
+def create_folders():
     # Создаем необходимые папки
     folders = ['static/uploads', 'static/css', 'static/js', 'templates']
     for folder in folders:
         os.makedirs(folder, exist_ok=True)
         print(f"✓ Папка создана/проверена: {folder}")
-    
-    # Запускаем приложение
-    print("🚀 Запуск приложения 'Город Идей'...")
-    print("📊 Откройте в браузере: http://localhost:5000")
-    print("👑 Админ: admin / admin123")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+
+
+def post_fork(server, worker):
+    # Соединения, открытые в главном процессе при импорте приложения,
+    # не должны использоваться из нескольких процессов
+    import storage
+    import passwords
+    from models import db
+
+    with app.app_context():
+        storage.dispose_engines(db.engine)
+    # Пул хэширования паролей - до запуска потоков gthread worker'а
+    passwords.hasher.start()
+
+
+def worker_exit(server, worker):
+    import database
+
+    flushed = database.flush_views()
+    if flushed:
+        server.log.info("Worker %s: записано просмотров: %s", worker.pid, flushed)
+
+
+def serve(args):
+    """Рабочий режим: gunicorn с предзагрузкой приложения"""
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': args.bind,
+                'workers': args.workers,
+                'threads': args.threads,
+                'worker_class': 'gthread' if args.threads > 1 else 'sync',
+                'preload_app': True,
+                'max_requests': args.max_requests,
+                'max_requests_jitter': args.max_requests // 2,
+                'timeout': args.timeout,
+                'graceful_timeout': args.graceful_timeout,
+                'accesslog': args.access_log,
+                'post_fork': post_fork,
+                'worker_exit': worker_exit,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Запуск приложения "Город Идей"')
+    parser.add_argument('--workers', type=int,
+                        help='Число процессов; без этого параметра запускается сервер разработки')
+    parser.add_argument('--threads', type=int, default=1, help='Число потоков в каждом процессе')
+    parser.add_argument('--bind', default='0.0.0.0:5000', help='Адрес и порт')
+    parser.add_argument('--max-requests', type=int, default=1000,
+                        help='Перезапускать worker после стольких запросов (0 - никогда)')
+    parser.add_argument('--timeout', type=int, default=30, help='Таймаут запроса, с')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='Сколько ждать текущих запросов при остановке, с')
+    parser.add_argument('--access-log', help='Файл журнала запросов ("-" - stdout)')
+    args = parser.parse_args()
+
+    create_folders()
+
+    if args.workers:
+        print(f"🚀 Запуск 'Город Идей': {args.workers} процессов x {args.threads} потоков на {args.bind}")
+        serve(args)
+    else:
+        # Запускаем приложение
+        print("🚀 Запуск приложения 'Город Идей'...")
+        print("📊 Откройте в браузере: http://localhost:5000")
+        print("👑 Админ: admin / admin123")
+        app.run(debug=True, host='0.0.0.0', port=5000)
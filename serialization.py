@@ -0,0 +1,150 @@
+"""
+Лёгкие записи для строк выборок и быстрый JSON.
+
+Функции database.py читают не ORM-объекты, а кортежи нужных колонок, и
+строка результата становится записью (record_type) без копирования полей в
+словарь: запись - подкласс namedtuple. Она читается и как объект
+(idea.title), и как словарь (idea['title'], idea.get('image_path')), так что
+шаблоны и код, написанный для словарей, работают без изменений. Записи
+неизменяемы: новое значение поля - через _replace.
+
+Время форматируется в 'YYYY-MM-DD HH:MM:SS' в самом SQL-запросе
+(timestamp_text): Python не разбирает строку в datetime и не вызывает
+strftime на каждой строке.
+
+JSON кодируется orjson, если он установлен, иначе стандартным json.
+"""
+import functools
+from collections import namedtuple
+from datetime import datetime
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import String, func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import TypeDecorator
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - необязательная зависимость
+    orjson = None
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# ------------------------------------------------------------
+# Записи
+# ------------------------------------------------------------
+class Record:
+    """Доступ к полям namedtuple по имени, как у словаря"""
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._fields
+
+    def to_dict(self):
+        return dict(zip(self._fields, self))
+
+
+@functools.lru_cache(maxsize=None)
+def record_type(fields):
+    """Класс записи для кортежа имён полей (один на набор полей)"""
+    base = namedtuple('Row', fields)
+    return type('Row', (Record, base), {'__slots__': (), '_index': {f: i for i, f in enumerate(fields)}})
+
+
+def records(fields, rows):
+    """Строки выборки (кортежи в порядке fields) -> список записей"""
+    return list(map(record_type(tuple(fields))._make, rows))
+
+
+def record(fields, row):
+    return record_type(tuple(fields))._make(row) if row is not None else None
+
+
+# ------------------------------------------------------------
+# Время
+# ------------------------------------------------------------
+class TimestampText(TypeDecorator):
+    """Результат timestamp_text: строка; datetime от драйвера форматируется"""
+
+    impl = String
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, datetime):
+            return value.strftime(TIMESTAMP_FORMAT)
+        return value
+
+
+class timestamp_text(FunctionElement):
+    """Колонка даты, отформатированная как TIMESTAMP_FORMAT"""
+
+    type = TimestampText()
+    inherit_cache = True
+    name = 'timestamp_text'
+
+
+@compiles(timestamp_text)
+def _timestamp_text(element, compiler, **kw):
+    # Прочие СУБД: драйвер вернёт datetime, его отформатирует TimestampText
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(timestamp_text, 'sqlite')
+def _timestamp_text_sqlite(element, compiler, **kw):
+    return compiler.process(func.strftime(TIMESTAMP_FORMAT, *element.clauses.clauses), **kw)
+
+
+@compiles(timestamp_text, 'postgresql')
+def _timestamp_text_postgresql(element, compiler, **kw):
+    return compiler.process(func.to_char(*element.clauses.clauses, 'YYYY-MM-DD HH24:MI:SS'), **kw)
+
+
+# ------------------------------------------------------------
+# JSON
+# ------------------------------------------------------------
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+class JSONProvider(DefaultJSONProvider):
+    """JSON Flask (jsonify, app.json) через orjson, если он установлен.
+
+    Вывод всегда компактный и без сортировки ключей; datetime и прочее, что
+    orjson не кодирует сам, кодируется как в Flask. Записи в JSON не
+    превращаются - для ответа API собирается словарь.
+    """
+
+    sort_keys = False
+
+    # Вызовы с параметрами json (например, object_hook сериализатора сессии
+    # Flask) идут в стандартный json
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            kwargs.setdefault('separators', (',', ':'))
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS),
+                                        mimetype=self.mimetype)
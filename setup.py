@@ -66,6 +66,9 @@ def install_requirements():
         'Flask-SQLAlchemy==3.0.5',
         'Flask-Login==0.6.3',
         'Werkzeug==2.3.7',
+        'snowballstemmer==3.1.1',
+        'Pillow==10.4.0',
+        'orjson==3.8.3',
     ]
     
     print("\nУстановка зависимостей...")
@@ -94,6 +97,13 @@ def main():
     parser.add_argument('--setup', action='store_true', help='Настроить приложение с нуля')
     parser.add_argument('--run', action='store_true', help='Запустить приложение')
     parser.add_argument('--reset-db', action='store_true', help='Сбросить базу данных')
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help='Пересчитать счётчики статистики и сетку кластеров карты')
+    parser.add_argument('--migrate', action='store_true', help='Применить миграции схемы базы данных')
+    parser.add_argument('--check-indexes', action='store_true',
+                        help='Проверить планы типовых запросов на полный проход по таблицам')
+    parser.add_argument('--make-admin', metavar='USERNAME', help='Дать пользователю права администратора')
+    parser.add_argument('--revoke-admin', metavar='USERNAME', help='Снять с пользователя права администратора')
     
     args = parser.parse_args()
     
@@ -115,23 +125,67 @@ def main():
     elif args.reset_db:
         confirm = input("Вы уверены, что хотите сбросить базу данных? (y/n): ")
         if confirm.lower() == 'y':
-            from app import app, db
-            import os
+            from app import app
+            import database
             
             with app.app_context():
-                # Удаляем все таблицы
-                db.drop_all()
-                print("✓ Все таблицы удалены")
-                
-                # Создаем заново
-                db.create_all()
-                print("✓ Новые таблицы созданы")
-                
-                # Создаем администратора
-                create_admin_user()
+                # Удаляем все таблицы (вместе с индексом поиска) и создаём
+                # заново: администратор, города, индексы, счётчики
+                database.reset_db()
+                print("✓ Таблицы пересозданы")
+                print("✓ Администратор: admin / admin123")
             
             print("✅ База данных сброшена")
     
+    elif args.rebuild_stats:
+        from app import app
+        import database
+
+        with app.app_context():
+            counters = database.rebuild_stats()
+            print(f"✓ Счётчики статистики пересчитаны: {counters}")
+            cells = database.rebuild_map_cells()
+            print(f"✓ Сетка кластеров карты пересчитана: {cells} ячеек")
+
+    elif args.migrate:
+        from app import app
+        import migrations
+
+        with app.app_context():
+            # init_db при импорте app уже применил недостающие миграции
+            applied = migrations.applied_versions()
+            for version, name, _ in migrations.MIGRATIONS:
+                print(f"{'✓' if version in applied else '✗'} {version}: {name}")
+
+    elif args.check_indexes:
+        from app import app, db
+        import migrations
+
+        with app.app_context():
+            if db.engine.dialect.name != 'sqlite':
+                print("Проверка планов запросов доступна только для SQLite")
+                sys.exit(0)
+            problems = migrations.check_query_plans()
+            for statement, detail in problems:
+                print(f"✗ {detail}\n  {' '.join(statement.split())}\n")
+            if problems:
+                print(f"Запросов с полным проходом по таблице: {len(problems)}")
+                sys.exit(1)
+            print("✓ Все типовые запросы используют индексы")
+
+    elif args.make_admin or args.revoke_admin:
+        from app import app
+        import database
+
+        username = args.make_admin or args.revoke_admin
+        with app.app_context():
+            user = database.get_user_by_username(username)
+            if not user:
+                print(f"✗ Пользователь {username} не найден")
+                sys.exit(1)
+            database.set_user_admin(user['id'], bool(args.make_admin))
+            print(f"✓ {username}: {'администратор' if args.make_admin else 'обычный пользователь'}")
+
     elif args.run:
         print("Запуск приложения...")
         subprocess.run([sys.executable, "app.py"])
@@ -38,25 +38,42 @@ function loadIdeasOnMap() {
     markersLayer.clearLayers();
     
     // Загружаем идеи с сервера
-    fetch('/api/ideas')
-        .then(response => response.json())
-        .then(ideas => {
-            ideas.forEach(idea => {
-                const marker = L.marker([idea.lat, idea.lng])
-                    .addTo(markersLayer)
-                    .bindPopup(`
-                        <div class="map-popup">
-                            <h6>${idea.title}</h6>
-                            <p><small>${idea.category} | 👍 ${idea.votes}</small></p>
-                            <p>${idea.description.substring(0, 100)}...</p>
-                            <a href="/idea/${idea.id}" class="btn btn-sm btn-primary">Подробнее</a>
-                        </div>
-                    `);
-            });
+    streamIdeasOnMap();
+}
+
+// Поток идей в формате NDJSON (по идее на строку): маркер ставится,
+// как только пришла его строка, не дожидаясь конца ответа
+function streamIdeasOnMap() {
+    fetch('/api/ideas', {cache: 'no-cache', headers: {'Accept': 'application/x-ndjson'}})
+        .then(async response => {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const {done, value} = await reader.read();
+                buffer += decoder.decode(value || new Uint8Array(), {stream: !done});
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                lines.filter(line => line).forEach(line => addIdeaMarker(JSON.parse(line)));
+                if (done) break;
+            }
         })
         .catch(error => console.error('Ошибка загрузки идей:', error));
 }
 
+function addIdeaMarker(idea) {
+    L.marker([idea.lat, idea.lng])
+        .addTo(markersLayer)
+        .bindPopup(`
+            <div class="map-popup">
+                <h6>${idea.title}</h6>
+                <p><small>${idea.category} | 👍 ${idea.votes}</small></p>
+                <p>${idea.description.substring(0, 100)}...</p>
+                <a href="/idea/${idea.id}" class="btn btn-sm btn-primary">Подробнее</a>
+            </div>
+        `);
+}
+
 // Включение/выключение режима добавления идей
 function toggleAddIdeaMode() {
     addIdeaMode = !addIdeaMode;
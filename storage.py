@@ -0,0 +1,160 @@
+"""
+Профиль хранения SQLite для рабочего режима.
+
+По умолчанию SQLite работает с журналом отката: пишущая транзакция
+блокирует читателей, и под одновременными голосами и просмотрами запросы
+получают "database is locked". Профиль 'production' (SQLITE_PROFILE):
+
+* включает WAL - читатели не ждут писателя и видят последнее
+  зафиксированное состояние;
+* на каждом соединении задаёт synchronous=NORMAL (в WAL это безопасно для
+  целостности), busy_timeout, mmap_size и cache_size;
+* разводит запросы сессии по двум пулам: SELECT вне пишущей транзакции
+  идут в пул соединений только для чтения, всё остальное - в пул из
+  одного соединения, так что записи процесса выполняются по очереди и не
+  соревнуются за блокировку.
+
+Профиль 'default' оставляет SQLite как есть. Для других СУБД и базы в
+памяти профиль не применяется.
+"""
+import os
+import threading
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql import Select, CompoundSelect, TextClause
+
+PROFILES = {
+    'default': None,
+    'production': {
+        'writer': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -32000,  # в КиБ: 32 МБ на соединение
+        },
+        'reader': {
+            'busy_timeout': 5000,
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -32000,
+            'query_only': 1,
+        },
+    },
+}
+READ_POOL_SIZE = 8
+WRITE_POOL_TIMEOUT = 30
+
+_read_engines = {}
+_lock = threading.Lock()
+
+
+def _is_file_sqlite(uri):
+    return uri.startswith('sqlite') and uri not in ('sqlite://', 'sqlite:///:memory:') and ':memory:' not in uri
+
+
+def _profile(app):
+    name = app.config['SQLITE_PROFILE']
+    if name not in PROFILES:
+        raise ValueError(f'Неизвестный профиль SQLite: {name}')
+    if not _is_file_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+        return None
+    return PROFILES[name]
+
+
+def configure(app):
+    """Параметры движка; вызывается до db.init_app"""
+    app.config.setdefault('SQLITE_PROFILE', os.environ.get('SQLITE_PROFILE', 'production'))
+    app.config.setdefault('SQLITE_READ_POOL_SIZE', int(os.environ.get('SQLITE_READ_POOL_SIZE', READ_POOL_SIZE)))
+    if _profile(app):
+        # Единственное соединение для записи: остальные потоки ждут его в пуле
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('pool_size', 1)
+        options.setdefault('max_overflow', 0)
+        options.setdefault('pool_timeout', WRITE_POOL_TIMEOUT)
+
+
+def _set_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def init_engines(app, engine):
+    """PRAGMA для соединений и пул для чтения; вызывается в app context
+    до первого обращения к базе"""
+    profile = _profile(app)
+    if not profile or engine in _read_engines:
+        return
+    _set_pragmas(engine, profile['writer'])
+    size = app.config['SQLITE_READ_POOL_SIZE']
+    reader = create_engine(engine.url, pool_size=size, max_overflow=size,
+                           connect_args={'check_same_thread': False})
+    _set_pragmas(reader, profile['reader'])
+    with _lock:
+        _read_engines[engine] = reader
+
+
+def read_engine(engine):
+    """Пул для чтения, соответствующий движку engine (None, если профиль не включён)"""
+    return _read_engines.get(engine)
+
+
+def _is_read(clause):
+    if isinstance(clause, (Select, CompoundSelect)):
+        return clause._for_update_arg is None
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip()[:6].upper() == 'SELECT'
+    return False
+
+
+class RoutingSession(Session):
+    """Сессия, отправляющая чтения в пул для чтения.
+
+    После первой записи транзакции все её запросы, в том числе SELECT, идут
+    через соединение записи - чтобы видеть свои же незафиксированные изменения.
+    """
+
+    _writing = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None:
+            return engine
+        reader = _read_engines.get(engine)
+        if reader is None:
+            return engine
+        if not self._writing and clause is not None and _is_read(clause):
+            return reader
+        self._writing = True
+        return engine
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._writing = False
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._writing = False
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._writing = False
+
+
+def dispose_engines(engine):
+    """Сбрасывает пулы соединений после fork: соединения SQLite, открытые в
+    родительском процессе, нельзя использовать в дочернем"""
+    engine.dispose(close=False)
+    reader = _read_engines.get(engine)
+    if reader is not None:
+        reader.dispose(close=False)
@@ -0,0 +1,79 @@
+"""
+Общие фикстуры тестов.
+
+Приложение создаёт базу при импорте app, поэтому DATABASE_URL указывает на
+временный файл до импорта. База одна на весь прогон: тесты создают свои
+города, пользователей и идеи и проверяют только их.
+"""
+import os
+import sys
+import atexit
+import shutil
+import itertools
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmpdir = tempfile.mkdtemp(prefix='gorod-idei-tests-')
+atexit.register(shutil.rmtree, _tmpdir, ignore_errors=True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'test.db')
+# Хэш пароля - в потоке теста, без пула процессов и с малым числом итераций
+os.environ['PASSWORD_POOL_SIZE'] = '0'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+
+import pytest
+
+_names = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def admin_client(client):
+    response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert response.status_code == 302
+    return client
+
+
+def unique_name(prefix):
+    return f'{prefix}{next(_names)}'
+
+
+@pytest.fixture
+def make_city(app_context):
+    import database
+
+    def make():
+        city_id = database.create_city(unique_name('Город '), '', 55.0, 86.0)
+        assert city_id
+        return city_id
+    return make
+
+
+@pytest.fixture
+def make_user(app_context):
+    import database
+
+    def make():
+        name = unique_name('user')
+        user_id = database.create_user(name, f'{name}@example.com', 'password')
+        assert user_id
+        return user_id
+    return make
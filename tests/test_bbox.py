@@ -0,0 +1,27 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.mark.parametrize('url', [
+    '/api/ideas/clusters?bbox=nan,nan,nan,nan&zoom=5',
+    '/api/ideas/clusters?bbox=-inf,-90,inf,90&zoom=5',
+    '/api/ideas/points?bbox=nan,1,2,3',
+    '/api/ideas?bbox=1,2,3,inf',
+    '/api/ideas?bbox=3,2,1,4',
+])
+def test_invalid_bbox_is_rejected(admin_client, url):
+    assert admin_client.get(url).status_code == 400
+
+
+@pytest.mark.parametrize('url', [
+    '/api/ideas/clusters?bbox=-500,-100,500,100&zoom=3',
+    '/api/ideas/points?bbox=-500,-100,500,100',
+])
+def test_out_of_range_bbox_is_clamped(admin_client, url):
+    assert admin_client.get(url).status_code == 200
+
+
+def test_parse_bbox_clamps_to_map():
+    assert app_module.parse_bbox('-200,-95,10,20') == (-180.0, -90.0, 10.0, 20.0)
+    assert app_module.parse_bbox('190,0,200,10') == (180.0, 0.0, 180.0, 10.0)
@@ -0,0 +1,26 @@
+import database
+
+
+def test_etag_revalidates_until_data_changes(admin_client, make_city):
+    response = admin_client.get('/api/cities')
+    etag = response.headers['ETag']
+    assert admin_client.get('/api/cities', headers={'If-None-Match': etag}).status_code == 304
+
+    make_city()
+    response = admin_client.get('/api/cities', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_etag_changes_after_reset(app, admin_client):
+    # Сразу после сброса версии такие же, как после прошлого сброса, -
+    # различает их только номер экземпляра базы
+    with app.app_context():
+        database.reset_db()
+    etag = admin_client.get('/api/cities').headers['ETag']
+
+    with app.app_context():
+        database.reset_db()
+    response = admin_client.get('/api/cities', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
@@ -0,0 +1,42 @@
+import base64
+import json
+
+import pytest
+
+import database
+
+
+def _cursor(raw):
+    # Сырой JSON: json.dumps не запишет 1e999
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('url, raw', [
+    ('/ideas?sort=popular&after={}', '[1e999,1]'),
+    ('/ideas?after={}', '["2024-01-01",99999999999999999999999]'),
+    ('/ideas?before={}', '["2024-01-01",1.5]'),
+    ('/ideas?sort=popular&before={}', '["1",1]'),
+    ('/api/ideas?sort=popular&after={}', '[1e308,1]'),
+    ('/api/ideas?sort=popular&after={}', '[-1e999,true]'),
+    ('/api/ideas?after={}', '[20240101,1]'),
+])
+def test_tampered_cursor_falls_back_to_first_page(admin_client, url, raw):
+    assert admin_client.get(url.format(_cursor(raw))).status_code == 200
+
+
+def test_decode_cursor_roundtrip():
+    assert database.decode_cursor(database.encode_cursor(7, 3), 'popular') == (7, 3)
+    assert database.decode_cursor(_cursor(json.dumps([7, 2 ** 63])), 'popular') is None
+    assert database.decode_cursor(_cursor(json.dumps([7, 2 ** 63 - 1])), 'popular') == (7, 2 ** 63 - 1)
+
+
+@pytest.mark.parametrize('raw', ['["o",1e999]', '["o",1180591620717411303424]', '["o",2.5]', '["o","10"]', '["o",-5]'])
+def test_tampered_search_cursor_falls_back_to_first_page(admin_client, raw):
+    for url in ('/ideas?q=парк&after={}', '/ideas?q=парк&before={}', '/api/ideas?q=парк&after={}'):
+        assert admin_client.get(url.format(_cursor(raw))).status_code == 200
+
+
+def test_search_offset_is_capped():
+    assert database._decode_offset_cursor(_cursor('["o",20]')) == 20
+    assert database._decode_offset_cursor(_cursor('["o",2.5]')) == 0
+    assert database._decode_offset_cursor(_cursor('["o",1180591620717411303424]')) == database.MAX_SEARCH_OFFSET
@@ -0,0 +1,46 @@
+import pytest
+
+import database
+import images
+from models import db, Idea
+
+IMAGE_KEY = 'ab/abcdef0123456789'
+
+
+@pytest.fixture
+def deleted_images(monkeypatch):
+    deleted = []
+    monkeypatch.setattr(images, 'delete_image', lambda path, folder: deleted.append(path))
+    return deleted
+
+
+def _create(user_id, city_id):
+    return database.create_idea('Идея', 'Описание', 'спорт', 55.0, 86.0, user_id, city_id, IMAGE_KEY)
+
+
+def test_shared_image_is_deleted_with_last_idea(deleted_images, make_city, make_user):
+    city_id, user_id = make_city(), make_user()
+    first, second = _create(user_id, city_id), _create(user_id, city_id)
+
+    database.delete_idea(first)
+    assert deleted_images == []
+    database.delete_idea(second)
+    assert deleted_images == [IMAGE_KEY]
+
+
+def test_image_survives_failed_commit(deleted_images, monkeypatch, make_city, make_user):
+    city_id, user_id = make_city(), make_user()
+    idea_id = _create(user_id, city_id)
+
+    def fail():
+        raise RuntimeError('commit failed')
+    with monkeypatch.context() as patch:
+        patch.setattr(db.session, 'commit', fail)
+        with pytest.raises(RuntimeError):
+            database.delete_idea(idea_id)
+    db.session.rollback()
+
+    assert deleted_images == []
+    assert db.session.get(Idea, idea_id) is not None
+    database.delete_idea(idea_id)
+    assert deleted_images == [IMAGE_KEY]
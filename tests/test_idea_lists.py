@@ -0,0 +1,54 @@
+import re
+
+import database
+from models import db
+
+
+def _create_implemented(count, user_id, city_id, comments=2):
+    for i in range(count):
+        idea_id = database.create_idea(f'Идея {i}', 'Описание', 'спорт', 55.0, 86.0, user_id, city_id)
+        database.update_idea_status(idea_id, 'implemented')
+        for j in range(comments):
+            database.add_comment(f'Комментарий {j}', user_id, idea_id)
+
+
+def _query_count(client, url):
+    # Первый запрос обновляет кэши процесса (города, пользователь), второй
+    # идёт сразу за ним и читает только сами данные страницы
+    client.get(url)
+    response = client.get(url)
+    assert response.status_code == 200
+    return int(response.headers['X-Query-Count']), response.get_data(as_text=True)
+
+
+def test_implemented_page_query_count_does_not_grow(app, admin_client, make_city, make_user):
+    app.config['METRICS_DEBUG_HEADERS'] = True
+    try:
+        city_id, user_id = make_city(), make_user()
+        url = f'/implemented?city_id={city_id}'
+
+        _create_implemented(2, user_id, city_id)
+        db.session.remove()
+        few, html = _query_count(admin_client, url)
+        assert len(re.findall(r'2 комментариев', html)) == 2
+
+        _create_implemented(15, user_id, city_id)
+        db.session.remove()
+        many, html = _query_count(admin_client, url)
+        assert len(re.findall(r'2 комментариев', html)) == 17
+    finally:
+        app.config['METRICS_DEBUG_HEADERS'] = False
+
+    assert many == few
+
+
+def test_list_records_include_comments_count_only_when_asked(app_context, make_city, make_user):
+    city_id, user_id = make_city(), make_user()
+    _create_implemented(3, user_id, city_id, comments=1)
+
+    page = database.get_ideas_page(status='implemented', city_id=city_id)
+    assert 'comments_count' not in page['ideas'][0].keys()
+
+    page = database.get_ideas_page(status='implemented', city_id=city_id,
+                                   fields=database.IDEA_LIST_FIELDS + ('comments_count',))
+    assert [idea.comments_count for idea in page['ideas']] == [1, 1, 1]
@@ -0,0 +1,22 @@
+import pytest
+
+import ideas_io
+from models import db, City
+
+
+def _row(**city):
+    return dict(title='Идея', description='Описание', category='спорт', latitude='55.0', longitude='86.0', **city)
+
+
+def test_city_name_wins_over_foreign_id(make_city):
+    first, second = make_city(), make_city()
+    second_name = db.session.get(City, second).name
+    validator = ideas_io.RowValidator('admin')
+
+    # Выгрузка другой базы: id указывает на другой город, чем название
+    assert validator.validate(_row(city_id=str(first), city_name=second_name))['city_id'] == second
+    assert validator.validate(_row(city_id=str(first)))['city_id'] == first
+    with pytest.raises(ValueError):
+        validator.validate(_row(city_id=str(first), city_name='Нет такого города'))
+    with pytest.raises(ValueError):
+        validator.validate(_row(city_id='999999'))
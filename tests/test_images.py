@@ -0,0 +1,50 @@
+import io
+
+import pytest
+from PIL import Image
+
+import database
+import images
+from models import db, Idea
+
+
+def _png(color):
+    data = io.BytesIO()
+    Image.new('RGB', (10, 10), color).save(data, 'PNG')
+    return data.getvalue()
+
+
+@pytest.fixture
+def broken_encoder(monkeypatch):
+    def fail(image):
+        raise OSError('encoder failed')
+    monkeypatch.setattr(images.ImageOps, 'exif_transpose', fail)
+
+
+def test_failed_processing_clears_committed_idea(app, broken_encoder, make_city, make_user):
+    idea_id = database.create_idea('Идея', 'Описание', 'спорт', 55.0, 86.0, make_user(), make_city(),
+                                   images.processor.save(_png((1, 2, 3)), app.config['UPLOAD_FOLDER']))
+    images.processor.wait()
+    db.session.remove()
+    assert db.session.get(Idea, idea_id).image_path is None
+
+
+def test_failure_before_commit_is_not_written(app, admin_client, broken_encoder, monkeypatch):
+    save = images.processor.save
+
+    def save_and_wait(data, upload_folder):
+        key = save(data, upload_folder)
+        images.processor.wait()
+        return key
+    monkeypatch.setattr(images.processor, 'save', save_and_wait)
+
+    response = admin_client.post('/add_idea', data={
+        'title': 'Идея с битой картинкой', 'description': 'Описание', 'category': 'спорт',
+        'latitude': '55.0', 'longitude': '86.0',
+        'image': (io.BytesIO(_png((4, 5, 6))), 'photo.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    with app.app_context():
+        idea = Idea.query.filter_by(title='Идея с битой картинкой').one()
+        assert idea.image_path is None
@@ -0,0 +1,40 @@
+import threading
+
+import passwords
+
+
+def _hasher():
+    return passwords.PasswordHasher('pbkdf2:sha256:1000', pool_size=1)
+
+
+def test_start_launches_pool_processes():
+    hasher = _hasher()
+    try:
+        hasher.start()
+        assert hasher._executor._processes
+        assert hasher.verify(hasher.hash('secret'), 'secret')
+    finally:
+        hasher.shutdown()
+
+
+def test_pool_created_from_threaded_process_does_not_fork():
+    hasher, stop = _hasher(), threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        pwhash = hasher.hash('secret')
+        assert hasher._executor._mp_context.get_start_method() != 'fork'
+        assert hasher.verify(pwhash, 'secret')
+        assert not hasher.verify(pwhash, 'other')
+    finally:
+        stop.set()
+        thread.join()
+        hasher.shutdown()
+
+
+def test_short_method_name_does_not_force_rehash():
+    hasher = passwords.PasswordHasher('pbkdf2:sha256', pool_size=0)
+    assert hasher.method.startswith('pbkdf2:sha256:') and len(hasher.method.split(':')) == 3
+    assert not hasher.needs_rehash(hasher.hash('secret'))
+    assert hasher.needs_rehash(passwords.PasswordHasher('pbkdf2:sha256:1000', pool_size=0).hash('secret'))
+    assert len(passwords.expand_method('scrypt').split(':')) == 4
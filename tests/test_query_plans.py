@@ -0,0 +1,5 @@
+import migrations
+
+
+def test_representative_queries_use_indexes(app_context):
+    assert migrations.check_query_plans() == []
@@ -0,0 +1,38 @@
+import database
+from models import db, Idea
+
+
+def _search_ids(q):
+    return [idea.id for idea in database.get_ideas_page(status='pending', q=q, limit=100)['ideas']]
+
+
+def test_reset_db_clears_search_index(app_context, make_user):
+    user_id = make_user()
+    database.create_idea('Старый фонтан', 'Описание', 'спорт', 55.0, 86.0, user_id)
+
+    database.reset_db()
+    assert db.session.query(Idea.id).first() is None
+    assert _search_ids('фонтан') == []
+
+    # id новых идей совпадают с удалёнными - индекс не должен мешать вставке
+    admin_id = database.get_user_by_username('admin').id
+    idea_id = database.create_idea('Новая аллея', 'Описание', 'спорт', 55.0, 86.0, admin_id)
+    assert _search_ids('аллея') == [idea_id]
+    assert _search_ids('фонтан') == []
+
+
+
+def test_reset_db_clears_spatial_index(app_context, make_user):
+    user_id = make_user()
+    for _ in range(3):
+        database.create_idea('Идея на севере', 'Описание', 'спорт', 60.0, 90.0, user_id)
+
+    database.reset_db()
+    admin_id = database.get_user_by_username('admin').id
+    idea_id = database.create_idea('Идея на юге', 'Описание', 'спорт', 50.0, 80.0, admin_id)
+
+    # В R*Tree только рамки существующих идей
+    rows = db.session.execute(db.text("SELECT id, min_lat, min_lng FROM idea_rtree")).all()
+    assert [(row.id, round(row.min_lat), round(row.min_lng)) for row in rows] == [(idea_id, 50, 80)]
+    south = database.get_ideas_page(status='pending', bbox=(79.0, 49.0, 81.0, 51.0))['ideas']
+    assert [idea.id for idea in south] == [idea_id]
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+import database
+from models import db, Idea, User
+
+
+def test_stats_match_direct_queries(app_context, make_city, make_user):
+    city_id, user_id = make_city(), make_user()
+    now = datetime.utcnow()
+    # Идеи по обе стороны границы 7x24 часа и в середине недели
+    for created_at in (now - timedelta(days=7, hours=1), now - timedelta(days=7) + timedelta(minutes=5),
+                       now - timedelta(days=3), now):
+        idea_id = database.create_idea('Идея', 'Описание', 'спорт', 55.0, 86.0, user_id, city_id)
+        Idea.query.filter_by(id=idea_id).update({'created_at': created_at})
+    db.session.commit()
+    database.rebuild_stats()
+
+    stats = database.get_stats()
+    week_ago = datetime.utcnow() - timedelta(days=7)
+    assert stats['recent_ideas'] == Idea.query.filter(Idea.created_at >= week_ago).count()
+
+    # Пользователи без идей тоже попадают в список, если активных меньше десяти
+    assert len(stats['active_users']) == min(10, User.query.count())
+    counts = [user['ideas_count'] for user in stats['active_users']]
+    assert counts == sorted(counts, reverse=True)
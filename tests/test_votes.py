@@ -0,0 +1,77 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+import database
+from models import db, Idea, Vote
+
+THREADS = 16
+
+
+def _create_ideas(count, user_id, city_id):
+    return [database.create_idea(f'Идея {i}', 'Описание', 'спорт', 55.0, 86.0, user_id, city_id)
+            for i in range(count)]
+
+
+def _assert_counted_once(ideas, expected_votes):
+    votes = dict(db.session.query(Vote.idea_id, func.count(Vote.id))
+                           .filter(Vote.idea_id.in_(ideas)).group_by(Vote.idea_id).all())
+    counts = dict(db.session.query(Idea.id, Idea.votes_count).filter(Idea.id.in_(ideas)).all())
+    assert counts == votes == {idea_id: expected_votes for idea_id in ideas}
+
+
+def test_parallel_votes_are_counted_once(app, make_user, make_city):
+    city_id = make_city()
+    users = [make_user() for _ in range(60)]
+    ideas = _create_ideas(20, users[0], city_id)
+    # 2400 попыток: каждый голос отправляется дважды из разных потоков
+    attempts = [(user_id, idea_id) for user_id in users for idea_id in ideas] * 2
+    random.Random(1).shuffle(attempts)
+    db.session.remove()
+
+    accepted = []
+    lock = threading.Lock()
+
+    def vote(attempt):
+        with app.app_context():
+            if database.add_vote(*attempt):
+                with lock:
+                    accepted.append(attempt)
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        list(pool.map(vote, attempts))
+
+    pairs = db.session.query(Vote.user_id, Vote.idea_id).filter(Vote.idea_id.in_(ideas)).all()
+    assert len(pairs) == len(set(pairs)) == len(users) * len(ideas)
+    assert sorted(accepted) == sorted(pairs)
+    _assert_counted_once(ideas, len(users))
+
+
+def test_contended_vote_is_accepted_once(app, make_user, make_city):
+    # Все потоки одновременно голосуют одной и той же парой пользователь/идея:
+    # принять голос должен ровно один, остальных отсекает ON CONFLICT
+    city_id = make_city()
+    users = [make_user() for _ in range(5)]
+    ideas = _create_ideas(8, users[0], city_id)
+    pairs = [(user_id, idea_id) for user_id in users for idea_id in ideas]
+    db.session.remove()
+
+    barrier = threading.Barrier(THREADS)
+    accepted = {pair: 0 for pair in pairs}
+    lock = threading.Lock()
+
+    def vote_all(_):
+        with app.app_context():
+            for pair in pairs:
+                barrier.wait()
+                if database.add_vote(*pair):
+                    with lock:
+                        accepted[pair] += 1
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        list(pool.map(vote_all, range(THREADS)))
+
+    assert accepted == {pair: 1 for pair in pairs}
+    _assert_counted_once(ideas, len(users))